@@ -1,4 +1,3 @@
-import io
 import os
 from datetime import datetime
 from email.headerregistry import Address
@@ -6,12 +5,12 @@ from email.message import EmailMessage
 from email.utils import make_msgid
 from pathlib import Path
 
-import ocha_stratus as stratus
 from dotenv import load_dotenv
 from html2text import html2text
 from jinja2 import Environment, FileSystemLoader
 
 from src.monitoring import etl, utils
+from src.utils import blob_cache
 
 load_dotenv()
 
@@ -90,15 +89,10 @@ if __name__ == "__main__":
 
         if not activation:
             blob_name = utils.get_plot_blob_name(monitoring_date, activation)
-            image_data = io.BytesIO()
-            blob_client = stratus.get_container_client().get_blob_client(
-                blob_name
-            )
-            blob_client.download_blob().download_to_stream(image_data)
-            image_data.seek(0)
-            msg.get_payload()[1].add_related(
-                image_data.read(), "image", "png", cid=chart_cid
-            )
+            with open(blob_cache.get_cached_blob_path(blob_name), "rb") as f:
+                msg.get_payload()[1].add_related(
+                    f.read(), "image", "png", cid=chart_cid
+                )
 
         for filename, cid in zip(
             ["centre_banner.png", "ocha_logo_wide.png"],
@@ -10,6 +10,7 @@ import xarray as xr
 from tqdm import tqdm
 
 from src.datasources import codab
+from src.utils import raster
 
 DATA_DIR = Path(os.environ["AA_DATA_DIR_NEW"])
 CHIRPS_RAW_DIR = DATA_DIR / "public" / "raw" / "nga" / "chirps" / "daily"
@@ -29,21 +30,16 @@ def calculate_raster_stats():
     ds = load_chirps_daily()
     adm = codab.load_codab(admin_level=2, aoi_only=True)
 
-    dfs = []
-    for pcode, group in tqdm(adm.groupby("ADM2_PCODE")):
-        ds_clip = ds.rio.clip(group.geometry, all_touched=True)
-        stats = ds_clip.mean(dim=["X", "Y"]).rename({"prcp": "mean"})
-
-        # for q in range(10, 91, 10):
-        #     stats[f"q{q}"] = ds_clip["prcp"].quantile(q / 100,
-        #     dim=["X", "Y"])
-        # stats = stats.drop_vars("quantile")
-        df_in = (
-            stats.to_dataframe().drop(columns=["spatial_ref"]).reset_index()
-        )
-        df_in["ADM2_PCODE"] = pcode
-        dfs.append(df_in)
-    df = pd.concat(dfs, ignore_index=True)
+    df = raster.compute_zonal_stats(
+        ds["prcp"],
+        adm,
+        "ADM2_PCODE",
+        x_dim="X",
+        y_dim="Y",
+        all_touched=True,
+    )
+    df = df.sort_values("ADM2_PCODE", kind="stable")
+    df = df[["T", "mean", "ADM2_PCODE"]]
 
     df["T"] = df["T"].dt.date
     filename = "chirps-daily-stats.csv"
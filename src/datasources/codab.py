@@ -2,7 +2,6 @@ import os
 from pathlib import Path
 
 import geopandas as gpd
-import ocha_stratus as stratus
 import requests
 from dotenv import load_dotenv
 
@@ -34,10 +33,9 @@ def download_codab_to_blob():
 
 def load_codab_from_blob(admin_level: int = 0, aoi_only: bool = False):
     shapefile = f"nga_adm{admin_level}.shp"
-    gdf = stratus.load_shp_from_blob(
+    gdf = blob.load_gdf_from_blob(
         f"{src.constants.PROJECT_PREFIX}/raw/codab/nga.shp.zip",
         shapefile=shapefile,
-        stage="dev",
     )
     if aoi_only:
         gdf = gdf[gdf["ADM1_PCODE"].isin(AOI_ADM1_PCODES)]
@@ -1,12 +1,16 @@
 import os
+import shutil
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-import rioxarray as rxr
+import pyarrow as pa
+import pyarrow.dataset as pads
+import rioxarray  # noqa: F401
 import xarray as xr
-from tqdm import tqdm
 
 from src.datasources import codab, worldpop
+from src.utils import raster
 
 DATA_DIR = Path(os.getenv("AA_DATA_DIR_NEW"))
 RAW_FS_HIST_S_PATH = (
@@ -20,22 +24,64 @@ RAW_FS_HIST_S_PATH = (
     / "aer_sfed_area_300s_19980112_20231231_v05r01.nc"
 )
 PROC_FS_DIR = DATA_DIR / "private" / "processed" / "nga" / "floodscan"
+# Days of the global archive read at a time when clipping
+CLIP_BLOCK_SIZE = 366
+# Days per chunk of the processed rasters
+TIME_CHUNK_SIZE = 30
+FS_ADM2_DAILY_DIR = PROC_FS_DIR / "nga_adm2_daily_mean_sfed"
 
+ADM2_DAILY_PARTITIONING = pads.partitioning(
+    pa.schema([("year", pa.int16())]), flavor="hive"
+)
+ADM2_DAILY_SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("ns")),
+        ("SFED_AREA", pa.float64()),
+        ("ADM2_PCODE", pa.string()),
+        ("year", pa.int16()),
+    ]
+)
 
-def clip_nga_from_glb():
-    ds = xr.open_dataset(RAW_FS_HIST_S_PATH)
-    da = ds["SFED_AREA"]
-    da = da.rio.set_spatial_dims(x_dim="lon", y_dim="lat")
-    da = da.rio.write_crs(4326)
+
+def clip_nga_from_glb(block_size: int = CLIP_BLOCK_SIZE):
+    """Clip Nigeria from the global SFED archive, a block of days at a
+    time.
+
+    Only the Nigeria window of each block is read, masked with a mask of
+    the country computed once, and appended to a compressed netCDF chunked
+    along time, so memory use depends on `block_size` and not on the
+    length of the archive.
+
+    Parameters
+    ----------
+    block_size : int, optional
+        Number of days read at a time, by default `CLIP_BLOCK_SIZE`.
+    """
+    ds_glb = xr.open_dataset(RAW_FS_HIST_S_PATH)
+    da = ds_glb["SFED_AREA"]
     adm0 = codab.load_codab(admin_level=0)
     lonmin, latmin, lonmax, latmax = adm0.total_bounds
     sfed_box = da.sel(lat=slice(latmax, latmin), lon=slice(lonmin, lonmax))
     sfed_box = sfed_box.rio.set_spatial_dims(x_dim="lon", y_dim="lat")
-    sfed_clip = sfed_box.rio.clip(adm0.geometry, all_touched=True)
-    if "grid_mapping" in sfed_clip.attrs:
-        del sfed_clip.attrs["grid_mapping"]
+    sfed_box = sfed_box.rio.write_crs(4326)
+    if "grid_mapping" in sfed_box.attrs:
+        del sfed_box.attrs["grid_mapping"]
+    mask = raster.geometry_mask(
+        adm0, sfed_box, x_dim="lon", y_dim="lat", all_touched=True
+    )
+    blocks = (
+        sfed_box.isel(time=slice(start, start + block_size)).load().where(mask)
+        for start in range(0, sfed_box["time"].size, block_size)
+    )
     filename = "nga_sfed_1998_2023.nc"
-    sfed_clip.to_netcdf(PROC_FS_DIR / filename)
+    raster.write_netcdf_blocks(
+        blocks,
+        PROC_FS_DIR / filename,
+        dim="time",
+        chunk_size=TIME_CHUNK_SIZE,
+        encoding={"SFED_AREA": da.encoding},
+    )
+    ds_glb.close()
 
 
 def load_raw_nga_floodscan():
@@ -46,38 +92,66 @@ def load_raw_nga_floodscan():
     return da
 
 
-def calculate_exposure_raster():
-    pop = worldpop.load_raw_worldpop()
+def calculate_exposure_raster(incremental: bool = False):
+    """Calculate the population in pixels flooded each year.
+
+    Each year's maximum SFED, where at least 5%, is regridded onto the
+    WorldPop grid with weights found once and cached (see
+    `raster.regrid_weights`), and multiplied by the population. Years are
+    processed one at a time and streamed to a compressed netCDF chunked by
+    year, so memory use is that of a single year.
+
+    Parameters
+    ----------
+    incremental : bool, optional
+        If True, only recalculate the last year already in the output,
+        which may have been stored from part of the year, and the years
+        after it, and write them over the end of the output. If False
+        (default), or there is no output yet, recalculate every year and
+        replace it.
+    """
+    pop = worldpop.load_raw_worldpop().isel(band=0)
     da = load_raw_nga_floodscan()
-    da_year = da.groupby("time.year").max()
+    path = PROC_FS_DIR / "nga_flood_exposure.nc"
+    years = np.unique(da["time"].dt.year)
+    append = incremental and path.exists()
+    if append:
+        with xr.open_dataarray(path) as existing:
+            last_year = existing["year"].max().item()
+        years = years[years >= last_year]
+        if years.size == 0:
+            print(f"No years from {last_year} on to process")
+            return
+    weights = raster.regrid_weights(da, pop, x_dim="lon", y_dim="lat")
+    blocks = (
+        _calculate_year_exposure(da, pop, weights, year) for year in years
+    )
+    raster.write_netcdf_blocks(
+        blocks, path, dim="year", chunk_size=1, append=append
+    )
+
+
+def _calculate_year_exposure(da, pop, weights, year):
+    da_year = da.sel(time=str(year)).max("time").astype("float32")
     da_year_mask = da_year.where(da_year >= 0.05)
-    da_year_mask = da_year_mask.rio.write_crs(4326)
-    da_year_mask = da_year_mask.transpose("year", "lat", "lon")
-    da_year_mask_resample = da_year_mask.rio.reproject_match(pop)
+    da_year_mask_resample = raster.regrid(
+        da_year_mask, pop, weights, x_dim="lon", y_dim="lat"
+    )
     da_year_mask_resample = da_year_mask_resample.where(
         da_year_mask_resample <= 1
     )
-    exposure = da_year_mask_resample * pop.isel(band=0)
-    exposure.to_netcdf(PROC_FS_DIR / "nga_flood_exposure.nc")
+    exposure = da_year_mask_resample * pop
+    return exposure.expand_dims(year=[year]).rename("exposure")
 
 
 def calculate_adm2_exposures():
     adm2 = codab.load_codab(admin_level=2)
     exposure = load_raster_flood_exposures()
-
-    dfs = []
-    for _, row in adm2.iterrows():
-        da_clip = exposure.rio.clip([row.geometry])
-        dff = (
-            da_clip.sum(dim=["x", "y"])
-            .to_dataframe(name="total_exposed")["total_exposed"]
-            .astype(int)
-            .reset_index()
-        )
-        dff["ADM2_PCODE"] = row["ADM2_PCODE"]
-        dfs.append(dff)
-
-    df = pd.concat(dfs, ignore_index=True)
+    df = raster.compute_weighted_zonal_stats(
+        exposure, adm2, "ADM2_PCODE", stats=("sum",)
+    )
+    df["total_exposed"] = df["sum"].round().astype(int)
+    df = df[["year", "total_exposed", "ADM2_PCODE"]]
     filename = "nga_adm2_count_flood_exposed.csv"
     df.to_csv(PROC_FS_DIR / filename, index=False)
 
@@ -92,29 +166,136 @@ def load_adm2_flood_exposures():
     return pd.read_csv(PROC_FS_DIR / filename)
 
 
-def calculate_adm2_daily_rasterstats():
+def calculate_adm2_daily_rasterstats(incremental: bool = False):
+    """Calculate the daily mean SFED of each AOI LGA.
+
+    Writes a parquet dataset under `FS_ADM2_DAILY_DIR`, partitioned by
+    year, with each file sorted by pcode and date. Load it with
+    `load_adm2_daily_rasterstats`.
+
+    Parameters
+    ----------
+    incremental : bool, optional
+        If True, only calculate the days after the last one already
+        stored, and rewrite just the year partitions they fall in, so a
+        daily update costs the same whatever the length of the record. If
+        False (default), or nothing is stored yet, recalculate every day
+        and replace the dataset.
+    """
     fs = load_raw_nga_floodscan()
-    fs = fs.rio.write_crs(4326)
     adm = codab.load_codab(admin_level=2, aoi_only=True)
-    dfs = []
-    for pcode, group in tqdm(adm.groupby("ADM2_PCODE")):
-        try:
-            da_clip = fs.rio.clip(group.geometry)
-        except rxr.exceptions.NoDataInBounds as e:
-            print(f"{e} for {pcode}")
-            continue
-        df_in = (
-            da_clip.mean(dim=["lat", "lon"])
-            .to_dataframe()["SFED_AREA"]
-            .reset_index()
-        )
-        df_in["ADM2_PCODE"] = pcode
-        dfs.append(df_in)
-    fs_df = pd.concat(dfs, ignore_index=True)
-    filename = "nga_adm2_daily_mean_sfed.csv"
-    fs_df.to_csv(PROC_FS_DIR / filename, index=False)
+    last_time = _get_last_adm2_daily_time() if incremental else None
+    if last_time is not None:
+        fs = fs.sel(time=fs["time"] > last_time)
+        if fs["time"].size == 0:
+            print(f"No days after {last_time:%Y-%m-%d} to process")
+            return
+    fs_df = raster.compute_zonal_stats(
+        fs, adm, "ADM2_PCODE", x_dim="lon", y_dim="lat"
+    )
+    fs_df = fs_df.rename(columns={"mean": "SFED_AREA"})
+    # Zones off the raster have no pixels, so no stats at all
+    names, _, zone_idx = raster.rasterize_zones(
+        adm, "ADM2_PCODE", fs, x_dim="lon", y_dim="lat"
+    )
+    has_pixels = set(zone_idx.tolist())
+    no_data = [x for i, x in enumerate(names) if i not in has_pixels]
+    for pcode in no_data:
+        print(f"No data found in bounds for {pcode}")
+    fs_df = fs_df[~fs_df["ADM2_PCODE"].isin(no_data)]
+    if fs_df.empty:
+        print("No LGA stats to write")
+        return
+    fs_df = fs_df.assign(year=fs_df["time"].dt.year)
+    if last_time is not None:
+        # Rewrite whole year partitions, rather than adding a file per run
+        years = fs_df["year"].unique().tolist()
+        stored = _load_adm2_daily_years(years)
+        fs_df = pd.concat([stored, fs_df], ignore_index=True)
+        fs_df = fs_df.drop_duplicates(["ADM2_PCODE", "time"], keep="last")
+    fs_df = fs_df.sort_values(["year", "ADM2_PCODE", "time"], kind="stable")
+    table = pa.Table.from_pandas(
+        fs_df[ADM2_DAILY_SCHEMA.names],
+        schema=ADM2_DAILY_SCHEMA,
+        preserve_index=False,
+    )
+    # Write next to the dataset and swap in, so a failed run keeps the
+    # stored stats
+    tmp_dir = FS_ADM2_DAILY_DIR.with_name(f"{FS_ADM2_DAILY_DIR.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    pads.write_dataset(
+        table,
+        tmp_dir,
+        format="parquet",
+        partitioning=ADM2_DAILY_PARTITIONING,
+        basename_template="part-{i}.parquet",
+    )
+    if last_time is None:
+        _replace_dir(tmp_dir, FS_ADM2_DAILY_DIR)
+    else:
+        for partition_dir in sorted(tmp_dir.iterdir()):
+            _replace_dir(partition_dir, FS_ADM2_DAILY_DIR / partition_dir.name)
+        shutil.rmtree(tmp_dir)
+
+
+def _replace_dir(src: Path, dst: Path):
+    """Move a directory to `dst`, replacing whatever is there. The old
+    directory is set aside next to `src`, not `dst`, so nothing stray is
+    left in a dataset if this fails halfway."""
+    old_dir = src.with_name(f"{src.name}.old")
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if dst.exists():
+        os.rename(dst, old_dir)
+    os.rename(src, dst)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _load_adm2_daily_years(years: list):
+    """Load the stored LGA stats of some years, with their year column."""
+    dataset = pads.dataset(
+        FS_ADM2_DAILY_DIR,
+        format="parquet",
+        partitioning=ADM2_DAILY_PARTITIONING,
+    )
+    table = dataset.to_table(
+        columns=ADM2_DAILY_SCHEMA.names,
+        filter=pads.field("year").isin(
+            pa.array(years, type=ADM2_DAILY_SCHEMA.field("year").type)
+        ),
+    )
+    return table.to_pandas()
+
+
+def _get_last_adm2_daily_time():
+    """Get the last day in the stored LGA stats, reading only the times in
+    the latest year, or None if nothing is stored."""
+    if not FS_ADM2_DAILY_DIR.exists():
+        return None
+    dataset = pads.dataset(
+        FS_ADM2_DAILY_DIR,
+        format="parquet",
+        partitioning=ADM2_DAILY_PARTITIONING,
+    )
+    years = [
+        pads.get_partition_keys(x.partition_expression)["year"]
+        for x in dataset.get_fragments()
+    ]
+    if not years:
+        return None
+    df = dataset.to_table(
+        columns=["time"],
+        filter=pads.field("year")
+        == pa.scalar(max(years), type=ADM2_DAILY_SCHEMA.field("year").type),
+    ).to_pandas()
+    return df["time"].max()
 
 
 def load_adm2_daily_rasterstats():
-    filename = "nga_adm2_daily_mean_sfed.csv"
-    return pd.read_csv(PROC_FS_DIR / filename, parse_dates=["time"])
+    dataset = pads.dataset(
+        FS_ADM2_DAILY_DIR,
+        format="parquet",
+        partitioning=ADM2_DAILY_PARTITIONING,
+    )
+    df = dataset.to_table(columns=["time", "SFED_AREA", "ADM2_PCODE"])
+    df = df.to_pandas()
+    return df.sort_values(["ADM2_PCODE", "time"], ignore_index=True)
@@ -1,10 +1,19 @@
+import hashlib
+import json
+import math
+import operator
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
 from pathlib import Path
 from typing import Literal
 
 import cdsapi
+import eccodes
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pads
 import xarray as xr
 from tqdm.auto import tqdm
 
@@ -16,7 +25,7 @@ from src.constants import (
     WUROBOKI_LAT,
     WUROBOKI_LON,
 )
-from src.utils import blob, cds_utils
+from src.utils import blob, blob_cache, cds_utils
 
 DATA_DIR = Path(os.getenv("AA_DATA_DIR", "."))
 GF_RAW_DIR = (
@@ -27,6 +36,25 @@ GF_REFORECAST_RAW_DIR = (
 )
 GF_TEST_DIR = DATA_DIR / "public" / "raw" / "nga" / "glofas" / "test"
 GF_PROC_DIR = DATA_DIR / "public" / "processed" / "nga" / "glofas"
+GF_REFORECAST_ENS_DIR = GF_PROC_DIR / "wuroboki_glofas_reforecast_ens"
+
+REFORECAST_ENS_PARTITIONING = pads.partitioning(
+    pa.schema([("year", pa.int16()), ("leadtime", pa.int8())]),
+    flavor="hive",
+)
+REFORECAST_ENS_SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("ns")),
+        ("valid_time", pa.timestamp("ns")),
+        ("number", pa.int16()),
+        ("dis24", pa.float32()),
+        ("year", pa.int16()),
+        ("leadtime", pa.int8()),
+    ]
+)
+# About a year of daily reanalysis per row group, so that reading a season
+# only downloads the row group(s) covering it
+REANALYSIS_ROW_GROUP_SIZE = 366
 
 
 GF_STATIONS = {
@@ -63,22 +91,261 @@ def get_blob_name(
     return f"{src.constants.PROJECT_PREFIX}/{data_type}/glofas/glofas_{dataset}_{station_name}.parquet"  # noqa
 
 
-def process_reanalysis():
-    """Process reanalysis for Wuroboki station only"""
-    files = [x for x in os.listdir(GF_RAW_DIR) if x.endswith(".grib")]
-    dfs = []
-    for file in tqdm(files):
-        da_in = xr.load_dataset(GF_RAW_DIR / file, engine="cfgrib")["dis24"]
-        df_in = (
-            da_in.sel(
-                latitude=WUROBOKI_LAT, longitude=WUROBOKI_LON, method="nearest"
-            )
-            .to_dataframe()
-            .reset_index()[["time", "dis24"]]
-        )
-        dfs.append(df_in)
+def get_reanalysis_partition_dir(station_name: str) -> str:
+    return f"{src.constants.PROJECT_PREFIX}/processed/glofas/glofas_reanalysis_{station_name}"  # noqa
+
+
+def get_reanalysis_partition_blob_name(station_name: str, year: int) -> str:
+    partition_dir = get_reanalysis_partition_dir(station_name)
+    return f"{partition_dir}/year={year}/part-0.parquet"
+
+
+def get_reanalysis_manifest_blob_name(station_name: str) -> str:
+    partition_dir = get_reanalysis_partition_dir(station_name)
+    return f"{partition_dir}/_manifest.json"
+
+
+def _map_files(func, filepaths, max_workers: int = 1) -> list:
+    """Apply `func` to each file, optionally across a process pool.
+
+    Results come back in the order of `filepaths` whichever worker finishes
+    first, so merging them gives the same output as the serial path.
+    """
+    if max_workers == 1:
+        return [func(x) for x in tqdm(filepaths)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(tqdm(executor.map(func, filepaths), total=len(filepaths)))
+
+
+def _get_grid_cells(gid, points: dict) -> dict:
+    """Find the grid cell nearest to each point on a regular grid.
+
+    Matches `.sel(..., method="nearest")` on the latitude and longitude
+    axes of the decoded field. Returns a mapping of point name to
+    `(index, lon, lat)`, where `index` is the position of the cell in the
+    message's values.
+    """
+    grid_type = eccodes.codes_get(gid, "gridType")
+    if grid_type != "regular_ll":
+        raise ValueError(f"Unsupported grid type: {grid_type}")
+    ni = eccodes.codes_get_long(gid, "Ni")
+    nj = eccodes.codes_get_long(gid, "Nj")
+    lat0 = eccodes.codes_get_double(gid, "latitudeOfFirstGridPointInDegrees")
+    lon0 = eccodes.codes_get_double(gid, "longitudeOfFirstGridPointInDegrees")
+    di = eccodes.codes_get_double(gid, "iDirectionIncrementInDegrees")
+    dj = eccodes.codes_get_double(gid, "jDirectionIncrementInDegrees")
+    if eccodes.codes_get_long(gid, "iScansNegatively"):
+        di = -di
+    if not eccodes.codes_get_long(gid, "jScansPositively"):
+        dj = -dj
+    lats = lat0 + np.arange(nj) * dj
+    lons = lon0 + np.arange(ni) * di
+    j_consecutive = eccodes.codes_get_long(gid, "jPointsAreConsecutive")
+    cells = {}
+    for name, (lon, lat) in points.items():
+        i = int(np.abs(lons - lon).argmin())
+        j = int(np.abs(lats - lat).argmin())
+        index = i * nj + j if j_consecutive else j * ni + i
+        cells[name] = (index, round(lons[i], 3), round(lats[j], 3))
+    return cells
+
+
+def _get_geometry_key(gid) -> tuple:
+    return tuple(
+        eccodes.codes_get(gid, key)
+        for key in [
+            "gridType",
+            "Ni",
+            "Nj",
+            "latitudeOfFirstGridPointInDegrees",
+            "longitudeOfFirstGridPointInDegrees",
+            "latitudeOfLastGridPointInDegrees",
+            "longitudeOfLastGridPointInDegrees",
+            "scanningMode",
+        ]
+    )
+
+
+def read_grib_points(filepath, points: dict) -> pd.DataFrame:
+    """Read values at one or more points from a GRIB file.
+
+    Messages are streamed one at a time, and only the values at the
+    requested points are decoded, so memory use does not depend on the size
+    of the file. The grid index of each point is worked out once per file
+    geometry.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Path to the GRIB file.
+    points : dict
+        Mapping of station name to `(lon, lat)`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Tidy DataFrame with columns `station`, `time` (forecast reference
+        time), `step`, `number` (ensemble member, 0 if not an ensemble) and
+        `value`.
+    """
+    names = list(points)
+    geometry_indices = {}
+    rows = {"time": [], "step": [], "number": [], "value": []}
+    if not names:
+        return _get_points_frame(names, rows)
+    with open(filepath, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                key = _get_geometry_key(gid)
+                if key not in geometry_indices:
+                    geometry_indices[key] = _get_grid_cells(gid, points)
+                cells = geometry_indices[key]
+                values = eccodes.codes_get_double_elements(
+                    gid, "values", [cells[x][0] for x in names]
+                )
+                if eccodes.codes_get_long(gid, "bitmapPresent"):
+                    missing = eccodes.codes_get_double(gid, "missingValue")
+                    values = [np.nan if x == missing else x for x in values]
+                eccodes.codes_set(gid, "stepUnits", "h")
+                number = (
+                    eccodes.codes_get_long(gid, "number")
+                    if eccodes.codes_is_defined(gid, "number")
+                    else 0
+                )
+                time = (
+                    f"{eccodes.codes_get_long(gid, 'dataDate')}"
+                    f"{eccodes.codes_get_long(gid, 'dataTime'):04}"
+                )
+                step = eccodes.codes_get_long(gid, "endStep")
+            finally:
+                eccodes.codes_release(gid)
+            rows["time"].extend([time] * len(names))
+            rows["step"].extend([step] * len(names))
+            rows["number"].extend([number] * len(names))
+            rows["value"].extend(values)
+    return _get_points_frame(names, rows)
+
+
+def _get_points_frame(names: list, rows: dict) -> pd.DataFrame:
+    n_messages = len(rows["value"]) // len(names) if names else 0
+    return pd.DataFrame(
+        {
+            "station": pd.Series(names * n_messages, dtype=str),
+            "time": pd.to_datetime(rows["time"], format="%Y%m%d%H%M").astype(
+                "datetime64[ns]"
+            ),
+            "step": pd.to_timedelta(rows["step"], unit="h").astype(
+                "timedelta64[ns]"
+            ),
+            "number": np.array(rows["number"], dtype=int),
+            "value": np.array(rows["value"], dtype=np.float32),
+        }
+    )
+
+
+def split_grib_to_points(filepath, points: dict, out_filepaths: dict):
+    """Write one single-point GRIB file per point from a multi-point file.
+
+    Each message is re-encoded on a 1 x 1 grid at the nearest grid cell, so
+    the outputs read back exactly like a file downloaded for that point
+    alone.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Path to the GRIB file covering all the points.
+    points : dict
+        Mapping of station name to `(lon, lat)`.
+    out_filepaths : dict
+        Mapping of station name to the output file path.
+    """
+    out_files = {}
+    try:
+        for name, out_filepath in out_filepaths.items():
+            Path(out_filepath).parent.mkdir(parents=True, exist_ok=True)
+            out_files[name] = open(out_filepath, "wb")
+        geometry_cells = {}
+        with open(filepath, "rb") as f:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(f)
+                if gid is None:
+                    break
+                try:
+                    key = _get_geometry_key(gid)
+                    if key not in geometry_cells:
+                        geometry_cells[key] = _get_grid_cells(gid, points)
+                    cells = geometry_cells[key]
+                    for name, out_file in out_files.items():
+                        index, lon, lat = cells[name]
+                        _write_grib_point(gid, index, lon, lat, out_file)
+                finally:
+                    eccodes.codes_release(gid)
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+
+
+def _write_grib_point(gid, index: int, lon: float, lat: float, out_file):
+    value = eccodes.codes_get_double_elements(gid, "values", [index])[0]
+    clone = eccodes.codes_clone(gid)
+    try:
+        for key, val in [
+            ("Ni", 1),
+            ("Nj", 1),
+            ("latitudeOfFirstGridPointInDegrees", lat),
+            ("latitudeOfLastGridPointInDegrees", lat),
+            ("longitudeOfFirstGridPointInDegrees", lon),
+            ("longitudeOfLastGridPointInDegrees", lon),
+        ]:
+            eccodes.codes_set(clone, key, val)
+        eccodes.codes_set_values(clone, np.array([value]))
+        eccodes.codes_write(clone, out_file)
+    finally:
+        eccodes.codes_release(clone)
+
+
+def _load_reanalysis_file(filepath) -> pd.DataFrame:
+    df_in = read_grib_points(
+        filepath, {"wuroboki": (WUROBOKI_LON, WUROBOKI_LAT)}
+    )
+    return df_in.rename(columns={"value": "dis24"})[["time", "dis24"]]
+
+
+def _load_reforecast_file(filepath, ensemble: bool = False) -> pd.DataFrame:
+    df_in = read_grib_points(
+        filepath, {"wuroboki": (WUROBOKI_LON, WUROBOKI_LAT)}
+    ).rename(columns={"value": "dis24"})
+    df_in["valid_time"] = df_in["time"] + df_in["step"]
+    df_in["leadtime"] = df_in["step"].dt.days
+    cols = ["time", "dis24", "valid_time", "leadtime"]
+    if ensemble:
+        df_in = df_in.sort_values(["number", "time", "step"], kind="stable")
+        cols = ["number"] + cols
+    else:
+        df_in = df_in.sort_values(["time", "step"], kind="stable")
+    return df_in[cols].reset_index(drop=True)
+
+
+def process_reanalysis(max_workers: int = 1):
+    """Process reanalysis for Wuroboki station only
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of processes used to decode the GRIB files, by default 1.
+        Pass None to use all available cores.
+    """
+    files = sorted(x for x in os.listdir(GF_RAW_DIR) if x.endswith(".grib"))
+    dfs = _map_files(
+        _load_reanalysis_file,
+        [GF_RAW_DIR / x for x in files],
+        max_workers=max_workers,
+    )
     df = pd.concat(dfs, ignore_index=True)
-    df = df.sort_values("time")
+    df = df.sort_values("time", kind="stable")
     filename = "wuroboki_glofas_reanalysis.csv"
     df.to_csv(GF_PROC_DIR / filename, index=False)
 
@@ -88,7 +355,22 @@ def load_reanalysis():
     return pd.read_csv(GF_PROC_DIR / filename, parse_dates=["time"])
 
 
-def download_reforecast_ensembles():
+def download_reforecast_ensembles(max_in_flight: int = 8, client=None):
+    """Download reforecast ensembles for Wuroboki station only
+
+    Requests are submitted concurrently with
+    `cds_utils.download_cds_requests`, with their state kept in
+    `GF_REFORECAST_RAW_DIR / "cds_manifest.json"` so that an interrupted run
+    resumes without resubmitting.
+
+    Parameters
+    ----------
+    max_in_flight : int, optional
+        Maximum number of requests queued on the CDS at once, by default 8.
+    client : ecmwf.datastores.Client, optional
+        Client to submit requests with, see
+        `cds_utils.download_cds_requests`.
+    """
     pitch = 0.005
     N, S, E, W = (
         WUROBOKI_LAT + pitch,
@@ -96,7 +378,6 @@ def download_reforecast_ensembles():
         WUROBOKI_LON + pitch,
         WUROBOKI_LON - pitch,
     )
-    c = cdsapi.Client()
 
     years = range(2003, 2023)
 
@@ -107,9 +388,10 @@ def download_reforecast_ensembles():
         for x in range(0, len(leadtimes), max_leadtime_chunk)
     ]
 
-    for leadtime_chunk in tqdm(leadtime_chunks):
+    jobs = {}
+    for leadtime_chunk in leadtime_chunks:
         lt_chunk_str = f"{leadtime_chunk[0]}-{leadtime_chunk[-1]}"
-        for year in tqdm(years):
+        for year in years:
             save_path = (
                 GF_REFORECAST_RAW_DIR
                 / f"wuroboki_reforecast_ens_{year}_lt{lt_chunk_str}.grib"
@@ -117,39 +399,44 @@ def download_reforecast_ensembles():
             if save_path.exists():
                 print(f"Skipping {year} {lt_chunk_str}, already exists")
                 continue
-            try:
-                c.retrieve(
-                    "cems-glofas-reforecast",
-                    {
-                        "system_version": "version_4_0",
-                        "hydrological_model": "lisflood",
-                        "product_type": [
-                            "ensemble_perturbed_reforecasts",
-                        ],
-                        "variable": "river_discharge_in_the_last_24_hours",
-                        "hyear": f"{year}",
-                        "hmonth": [
-                            "august",
-                            "july",
-                            "october",
-                            "september",
-                        ],
-                        "hday": [f"{x:02}" for x in range(1, 32)],
-                        "leadtime_hour": [str(x) for x in leadtime_chunk],
-                        "format": "grib",
-                        "area": [
-                            N,
-                            W,
-                            S,
-                            E,
-                        ],
-                    },
-                    save_path,
-                )
+            jobs[str(save_path)] = (
+                "cems-glofas-reforecast",
+                {
+                    "system_version": "version_4_0",
+                    "hydrological_model": "lisflood",
+                    "product_type": [
+                        "ensemble_perturbed_reforecasts",
+                    ],
+                    "variable": "river_discharge_in_the_last_24_hours",
+                    "hyear": f"{year}",
+                    "hmonth": [
+                        "august",
+                        "july",
+                        "october",
+                        "september",
+                    ],
+                    "hday": [f"{x:02}" for x in range(1, 32)],
+                    "leadtime_hour": [str(x) for x in leadtime_chunk],
+                    "format": "grib",
+                    "area": [
+                        N,
+                        W,
+                        S,
+                        E,
+                    ],
+                },
+            )
 
-            except Exception as e:
-                print(f"Failed to download {year} {lt_chunk_str}")
-                print(e)
+    states = cds_utils.download_cds_requests(
+        jobs,
+        manifest_path=GF_REFORECAST_RAW_DIR / "cds_manifest.json",
+        max_in_flight=max_in_flight,
+        to_blob=False,
+        client=client,
+    )
+    for save_path, state in states.items():
+        if state == "failed":
+            print(f"Failed to download {save_path}")
 
 
 def download_reforecast(clobber: bool = False):
@@ -215,82 +502,211 @@ def download_reforecast(clobber: bool = False):
             print(e)
 
 
-def process_reforecast():
-    """Process reforecast data for Wuroboki station only"""
-    files = [
-        x for x in os.listdir(GF_REFORECAST_RAW_DIR) if x.endswith(".grib")
-    ]
-    dfs = []
-    for file in tqdm(files):
-        da_in = xr.load_dataset(
-            GF_REFORECAST_RAW_DIR / file,
-            engine="cfgrib",
-            backend_kwargs={
-                "indexpath": "",
-            },
-        )
-        df_in = (
-            da_in.sel(
-                latitude=WUROBOKI_LAT, longitude=WUROBOKI_LON, method="nearest"
-            )
-            .to_dataframe()[["dis24", "valid_time"]]
-            .reset_index()
-        )
-        df_in["leadtime"] = df_in["step"].dt.days
-        df_in = df_in.drop(columns=["step"])
-        dfs.append(df_in)
+def process_reforecast(max_workers: int = 1):
+    """Process reforecast data for Wuroboki station only
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of processes used to decode the GRIB files, by default 1.
+        Pass None to use all available cores.
+    """
+    # Ensemble files share the folder, and are processed separately by
+    # `process_reforecast_ensembles`
+    files = sorted(
+        x
+        for x in os.listdir(GF_REFORECAST_RAW_DIR)
+        if x.endswith(".grib") and "ens" not in x
+    )
+    dfs = _map_files(
+        _load_reforecast_file,
+        [GF_REFORECAST_RAW_DIR / x for x in files],
+        max_workers=max_workers,
+    )
     df = pd.concat(dfs, ignore_index=True)
-    df = df.sort_values("time")
+    df = df.sort_values("time", kind="stable")
     filename = "wuroboki_glofas_reforecast.csv"
     df.to_csv(GF_PROC_DIR / filename, index=False)
 
 
-def process_reforecast_ensembles():
-    filenames = [x for x in os.listdir(GF_REFORECAST_RAW_DIR) if "ens" in x]
+def process_reforecast_ensembles(max_workers: int = 1):
+    """Process reforecast ensembles for Wuroboki station only
 
-    dfs = []
-    for filename in tqdm(filenames):
-        filepath = GF_REFORECAST_RAW_DIR / filename
-        ds_in = xr.open_dataset(
-            filepath,
-            engine="cfgrib",
-            backend_kwargs={
-                "indexpath": "",
-            },
-        )
-        df_in = (
-            ds_in.sel(
-                latitude=WUROBOKI_LAT, longitude=WUROBOKI_LON, method="nearest"
-            )
-            .to_dataframe()[["dis24", "valid_time"]]
-            .reset_index()
-        )
-        df_in["leadtime"] = df_in["step"].dt.days
-        df_in = df_in.drop(columns=["step"])
-        dfs.append(df_in)
+    Writes a parquet dataset under `GF_REFORECAST_ENS_DIR`, partitioned by
+    issue year and leadtime, with each partition sorted by issue time and
+    member. Load it with `load_reforecast_ensembles`.
 
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of processes used to decode the GRIB files, by default 1.
+        Pass None to use all available cores.
+    """
+    filenames = sorted(
+        x for x in os.listdir(GF_REFORECAST_RAW_DIR) if "ens" in x
+    )
+    dfs = _map_files(
+        partial(_load_reforecast_file, ensemble=True),
+        [GF_REFORECAST_RAW_DIR / x for x in filenames],
+        max_workers=max_workers,
+    )
     df = pd.concat(dfs, ignore_index=True)
-    df = df.sort_values(["time", "leadtime"])
-    filename = "wuroboki_glofas_reforecast_ens.parquet"
-    df.to_parquet(GF_PROC_DIR / filename)
+    df["year"] = df["time"].dt.year
+    df = df.sort_values(["year", "leadtime", "time", "number"], kind="stable")
+    table = pa.Table.from_pandas(
+        df[REFORECAST_ENS_SCHEMA.names],
+        schema=REFORECAST_ENS_SCHEMA,
+        preserve_index=False,
+    )
+    pads.write_dataset(
+        table,
+        GF_REFORECAST_ENS_DIR,
+        format="parquet",
+        partitioning=REFORECAST_ENS_PARTITIONING,
+        existing_data_behavior="delete_matching",
+    )
 
 
-def process_reforecast_frac():
-    df = pd.read_parquet(
-        GF_PROC_DIR / "wuroboki_glofas_reforecast_ens.parquet"
+def load_reforecast_ensembles(
+    years: list = None,
+    leadtimes: list = None,
+    members: list = None,
+    columns: list = None,
+) -> pd.DataFrame:
+    """Load the partitioned reforecast ensembles.
+
+    Filters are pushed down to the parquet dataset, so only the matching
+    partitions and row groups are read.
+
+    Parameters
+    ----------
+    years : list, optional
+        Issue years to load, by default all.
+    leadtimes : list, optional
+        Leadtimes (in days) to load, by default all.
+    members : list, optional
+        Ensemble members to load, by default all.
+    columns : list, optional
+        Columns to load, by default all.
+
+    Returns
+    -------
+    pd.DataFrame
+        Ensemble discharge sorted by time, leadtime and member.
+    """
+    # Typed like the fields, as pushdown fails on mismatched types
+    filters = [
+        pads.field(col).isin(
+            pa.array(vals, type=REFORECAST_ENS_SCHEMA.field(col).type)
+        )
+        for col, vals in [
+            ("year", years),
+            ("leadtime", leadtimes),
+            ("number", members),
+        ]
+        if vals is not None
+    ]
+    dataset = pads.dataset(
+        GF_REFORECAST_ENS_DIR,
+        format="parquet",
+        partitioning=REFORECAST_ENS_PARTITIONING,
+    )
+    table = dataset.to_table(
+        columns=columns,
+        filter=reduce(operator.and_, filters) if filters else None,
+    )
+    df = table.to_pandas()
+    sort_cols = [x for x in ["time", "leadtime", "number"] if x in df]
+    return df.sort_values(sort_cols, ignore_index=True)
+
+
+def calculate_exceedance_fractions(
+    df: pd.DataFrame, thresholds, value_col: str = "dis24"
+) -> xr.DataArray:
+    """Calculate the fraction of ensemble members above each threshold.
+
+    All thresholds are handled in a single pass: each member is located
+    among the sorted thresholds with `searchsorted`, members are counted
+    per forecast and number of thresholds exceeded, and a reverse
+    cumulative sum gives the count above every threshold. Exceedance is
+    strict (`>`), and members with missing values count towards the
+    ensemble size but never exceed.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Ensemble forecasts with columns `time`, `leadtime` and `value_col`,
+        one row per member. If there is a `valid_time` column it is kept as
+        a coordinate.
+    thresholds : array_like
+        Thresholds to compare against, in any order.
+    value_col : str, optional
+        Name of the column with the forecast values, by default "dis24".
+
+    Returns
+    -------
+    xr.DataArray
+        Exceedance fractions with dimensions (time, leadtime, threshold).
+        Forecasts that don't appear in `df` are NaN.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    order = np.argsort(thresholds, kind="stable")
+    times, time_idx = np.unique(df["time"].to_numpy(), return_inverse=True)
+    leadtimes, leadtime_idx = np.unique(
+        df["leadtime"].to_numpy(), return_inverse=True
+    )
+    forecast_idx = time_idx * len(leadtimes) + leadtime_idx
+    n_forecasts = len(times) * len(leadtimes)
+    n_bins = len(thresholds) + 1
+
+    values = df[value_col].to_numpy(dtype=float)
+    n_exceeded = np.searchsorted(thresholds[order], values, side="left")
+    n_exceeded[np.isnan(values)] = 0
+    counts = np.bincount(
+        forecast_idx * n_bins + n_exceeded, minlength=n_forecasts * n_bins
+    ).reshape(n_forecasts, n_bins)
+    n_above = counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+    n_members = counts.sum(axis=1, keepdims=True)
+    frac = np.empty(n_above.shape)
+    with np.errstate(invalid="ignore"):
+        frac[:, order] = n_above / n_members
+
+    coords = {"time": times, "leadtime": leadtimes, "threshold": thresholds}
+    if "valid_time" in df:
+        valid_time = np.full(n_forecasts, np.datetime64("NaT", "ns"))
+        valid_time[forecast_idx] = df["valid_time"].to_numpy()
+        coords["valid_time"] = (
+            ("time", "leadtime"),
+            valid_time.reshape(len(times), len(leadtimes)),
+        )
+    return xr.DataArray(
+        frac.reshape(len(times), len(leadtimes), len(thresholds)),
+        dims=("time", "leadtime", "threshold"),
+        coords=coords,
+        name="frac",
     )
 
-    df["2yr_thresh"] = df["dis24"] > WUROBOKI_2YRPR
-    df["3yr_thresh"] = df["dis24"] > WUROBOKI_3YRPR
-    df["5yr_thresh"] = df["dis24"] > WUROBOKI_5YRPR
 
+def process_reforecast_frac():
+    df = load_reforecast_ensembles(
+        columns=["time", "leadtime", "valid_time", "dis24"]
+    )
+    thresholds = {
+        "2yr_thresh": WUROBOKI_2YRPR,
+        "3yr_thresh": WUROBOKI_3YRPR,
+        "5yr_thresh": WUROBOKI_5YRPR,
+    }
+    frac = calculate_exceedance_fractions(df, list(thresholds.values()))
     ens = (
-        df.groupby(["time", "leadtime", "valid_time"])[
-            [x for x in df.columns if "yr_thresh" in x]
-        ]
-        .mean()
+        frac.assign_coords(threshold=list(thresholds))
+        .to_dataset(dim="threshold")
+        .to_dataframe()
+        .dropna(subset=list(thresholds))
         .reset_index()
-    )
+    )[["time", "leadtime", "valid_time"] + list(thresholds)]
+    # Keep the int64 leadtime of this output from before the ensembles
+    # were stored as int8
+    ens["leadtime"] = ens["leadtime"].astype("int64")
     filename = "wuroboki_glofas_reforecast_frac.parquet"
     ens.to_parquet(GF_PROC_DIR / filename)
 
@@ -307,29 +723,128 @@ def load_reforecast():
     )
 
 
+def _get_grid_axis(start: float, stop: float, step: float) -> tuple:
+    # Same length and spacing as np.arange(start, stop, step), which fills
+    # values as start + i * ((start + step) - start)
+    return start, (start + step) - start, int(np.ceil((stop - start) / step))
+
+
+GLOFAS_GRID_LAT = _get_grid_axis(-90.025, 90, 0.05)
+GLOFAS_GRID_LON = _get_grid_axis(-180.025, 180, 0.05)
+
+
+def _snap_to_grid_axis(x, axis: tuple):
+    start, delta, n = axis
+    if np.ndim(x) == 0:
+        # Plain float arithmetic is much faster than numpy for one point
+        x = float(x)
+        if math.isnan(x):
+            return math.nan
+        lowest = min(max(math.floor((x - start) / delta) - 1, 0), n - 1)
+        values = [start + k * delta for k in range(lowest, min(lowest + 3, n))]
+        return min(values, key=lambda v: abs(v - x))
+    x = np.asarray(x, dtype=float)
+    # Check the cells either side of the estimate to absorb rounding, and
+    # keep the lowest index on ties, as argmin does
+    estimate = np.clip(np.floor(np.nan_to_num((x - start) / delta)), -1, n)
+    idx = estimate.astype(int)[..., None] + [-1, 0, 1]
+    idx = np.clip(idx, 0, n - 1)
+    values = start + idx * delta
+    nearest = np.abs(values - x[..., None]).argmin(axis=-1)
+    snapped = np.take_along_axis(values, nearest[..., None], axis=-1)[..., 0]
+    return np.where(np.isnan(x), np.nan, snapped)
+
+
 def get_glofas_grid_coords(lon, lat):
-    grid_lat = np.arange(-90.025, 90, 0.05)
-    grid_lon = np.arange(-180.025, 180, 0.05)
-    nearest_lat_idx = (np.abs(grid_lat - lat)).argmin()
-    nearest_lon_idx = (np.abs(grid_lon - lon)).argmin()
-    return round(grid_lon[nearest_lon_idx], 3), round(
-        grid_lat[nearest_lat_idx], 3
+    """Snap coordinates to the nearest cell centre of the 0.05 degree GloFAS
+    grid.
+
+    Parameters
+    ----------
+    lon, lat : float or array_like
+        Longitude(s) and latitude(s) to snap.
+
+    Returns
+    -------
+    tuple
+        Snapped `(lon, lat)`, rounded to 3 decimal places. Scalars for
+        scalar input, arrays otherwise. NaN coordinates stay NaN.
+    """
+    grid_lon = np.round(_snap_to_grid_axis(lon, GLOFAS_GRID_LON), 3)
+    grid_lat = np.round(_snap_to_grid_axis(lat, GLOFAS_GRID_LAT), 3)
+    return grid_lon, grid_lat
+
+
+def get_stations_area(station_names: list, pitch: float = 0.001) -> list:
+    """Get the smallest [N, W, S, E] area covering the GloFAS grid cells of
+    all the stations. For a single station this is the same as
+    `get_coords`."""
+    lons, lats = zip(
+        *[
+            get_glofas_grid_coords(
+                GF_STATIONS[x]["lon"], GF_STATIONS[x]["lat"]
+            )
+            for x in station_names
+        ]
     )
+    return [max(lats) + pitch, min(lons), min(lats), max(lons) + pitch]
 
 
-def download_glofas_reanalysis_year_to_blob(
-    year: int, station_name: str, pitch: float = 0.001, clobber: bool = False
+def download_glofas_stations_to_blob(
+    dataset: str,
+    request: dict,
+    blob_names: dict,
+    pitch: float = 0.001,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    keep_local_copy: bool = True,
 ):
-    station = GF_STATIONS[station_name]
-    glofas_lon, glofas_lat = get_glofas_grid_coords(
-        station["lon"], station["lat"]
-    )
-    N = glofas_lat + pitch
-    S = glofas_lat
-    E = glofas_lon + pitch
-    W = glofas_lon
-    dataset = "cems-glofas-historical"
+    """Download data for several stations with a single CDS request, and
+    upload one single-point GRIB blob per station.
+
+    Parameters
+    ----------
+    dataset : str
+        CDS dataset name.
+    request : dict
+        CDS request, without `area`. The area is set to cover all the
+        stations.
+    blob_names : dict
+        Mapping of station name to the blob name to upload its data to.
+    pitch : float, optional
+        Padding added to the north and east of the area, by default 0.001.
+    prod_dev : Literal["prod", "dev"], optional
+        Stage to upload to, by default "dev".
+    keep_local_copy : bool, optional
+        Whether to keep the per-station files in `temp/`, by default True.
+    """
     request = {
+        **request,
+        "area": get_stations_area(list(blob_names), pitch=pitch),
+    }
+    request_hash = hashlib.md5(
+        json.dumps(request, sort_keys=True).encode()
+    ).hexdigest()
+    batch_filepath = Path("temp") / "cds_batch" / f"{request_hash}.grib"
+    cds_utils.download_raw_cds_api(dataset, request, batch_filepath)
+    points = {
+        x: get_glofas_grid_coords(GF_STATIONS[x]["lon"], GF_STATIONS[x]["lat"])
+        for x in blob_names
+    }
+    local_filepaths = {x: "temp" / Path(y) for x, y in blob_names.items()}
+    split_grib_to_points(batch_filepath, points, local_filepaths)
+    os.remove(batch_filepath)
+    for station_name, blob_name in blob_names.items():
+        cds_utils.upload_local_file_to_blob(
+            local_filepaths[station_name],
+            blob_name,
+            prod_dev=prod_dev,
+            keep_local_copy=keep_local_copy,
+        )
+    return local_filepaths if keep_local_copy else None
+
+
+def _get_reanalysis_request(year: int) -> dict:
+    return {
         "system_version": ["version_4_0"],
         "hydrological_model": ["lisflood"],
         "product_type": ["consolidated"],
@@ -339,58 +854,162 @@ def download_glofas_reanalysis_year_to_blob(
         "hday": [f"{x:02}" for x in range(1, 32)],
         "data_format": "grib2",
         "download_format": "unarchived",
-        "area": [N, W, S, E],
     }
+
+
+def download_glofas_reanalysis_year_to_blob(
+    year: int, station_name: str, pitch: float = 0.001, clobber: bool = False
+):
+    station = GF_STATIONS[station_name]
+    glofas_lon, glofas_lat = get_glofas_grid_coords(
+        station["lon"], station["lat"]
+    )
+    N = glofas_lat + pitch
+    S = glofas_lat
+    E = glofas_lon + pitch
+    W = glofas_lon
+    dataset = "cems-glofas-historical"
+    request = {**_get_reanalysis_request(year), "area": [N, W, S, E]}
     blob_name = get_blob_name("raw", "reanalysis", station_name, year)
     # check if blob exists
-    if not clobber and blob.check_blob_exists(blob_name):
+    if not clobber and blob_name in blob.existing_blobs([blob_name]):
         print(f"{blob_name} already exists in blob storage")
         return
     return cds_utils.download_raw_cds_api_to_blob(dataset, request, blob_name)
 
 
+def download_glofas_reanalysis_stations_year_to_blob(
+    year: int,
+    station_names: list,
+    pitch: float = 0.001,
+    clobber: bool = False,
+):
+    """Download a year of reanalysis for several stations with one CDS
+    request. Stations that already have a blob for the year are skipped
+    unless `clobber` is set."""
+    blob_names = {
+        x: get_blob_name("raw", "reanalysis", x, year) for x in station_names
+    }
+    if not clobber:
+        existing = blob.existing_blobs(blob_names.values())
+        blob_names = {x: y for x, y in blob_names.items() if y not in existing}
+    if not blob_names:
+        print(f"{year} already exists in blob storage for all stations")
+        return
+    return download_glofas_stations_to_blob(
+        "cems-glofas-historical",
+        _get_reanalysis_request(year),
+        blob_names,
+        pitch=pitch,
+    )
+
+
 def load_glofas_reanalysis_year(
     data_type: Literal["raw", "processed"], station_name: str, year: int
 ):
     blob_name = get_blob_name(data_type, "reanalysis", station_name, year)
     if data_type == "raw":
-        local_filepath = "temp" / Path(blob_name)
-        if local_filepath.exists():
-            return xr.load_dataset(local_filepath)
-        else:
-            blob_data = blob.load_blob_data(blob_name)
-            print(f"Downloading {blob_name} to {local_filepath}")
-            if not local_filepath.parent.exists():
-                os.makedirs(local_filepath.parent)
-            with open(local_filepath, "wb") as file:
-                file.write(blob_data)
-            return xr.load_dataset(local_filepath)
+        return xr.load_dataset(blob_cache.get_cached_blob_path(blob_name))
     elif data_type == "processed":
         return blob.load_parquet_from_blob(blob_name)
 
 
-def process_glofas_reanalysis(station_name: str):
+def _process_glofas_reanalysis_year(
+    station_name: str, year: int
+) -> pd.DataFrame:
+    ds_year = load_glofas_reanalysis_year("raw", station_name, year)
+    da = ds_year["dis24"]
+    return da.to_dataframe().reset_index()[["time", "dis24"]]
+
+
+def load_reanalysis_manifest(station_name: str) -> dict:
+    """Load the record of raw yearly blobs already folded into the
+    partitioned reanalysis, or an empty dict if there is none yet."""
+    blob_name = get_reanalysis_manifest_blob_name(station_name)
+    if not blob.check_blob_exists(blob_name):
+        return {}
+    return json.loads(blob.load_blob_data(blob_name))
+
+
+def process_glofas_reanalysis(station_name: str, incremental: bool = False):
+    """Process the raw yearly reanalysis blobs for a station.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station in `GF_STATIONS`.
+    incremental : bool, optional
+        If False (default), decode every year and upload a single parquet.
+        If True, only decode years whose raw blob is new or has a different
+        ETag or size from the one recorded in the manifest, and write each
+        year to its own partition. The manifest is updated after each year,
+        so an interrupted run picks up where it left off.
+    """
     raw_blob_dir = "/".join(
         get_blob_name("raw", "reanalysis", station_name, year=0).split("/")[
             :-1
         ]
     )
-    blob_names = [
-        x
-        for x in blob.list_container_blobs(name_starts_with=raw_blob_dir)
-        if x.endswith(".grib")
-    ]
-    dfs = []
-    for blob_name in tqdm(blob_names):
+    raw_blobs = {
+        name: props
+        for name, props in blob.blob_metadata(prefix=raw_blob_dir).items()
+        if name.endswith(".grib")
+    }
+    if not incremental:
+        dfs = []
+        for blob_name in tqdm(raw_blobs):
+            year = int(blob_name.split(".")[0].split("_")[-1])
+            dfs.append(_process_glofas_reanalysis_year(station_name, year))
+        df = pd.concat(dfs, ignore_index=True)
+        df = df.sort_values("time")
+        blob_name = get_blob_name("processed", "reanalysis", station_name)
+        blob.upload_parquet_to_blob(
+            blob_name, df, row_group_size=REANALYSIS_ROW_GROUP_SIZE
+        )
+        return
+
+    manifest = load_reanalysis_manifest(station_name)
+    manifest_blob_name = get_reanalysis_manifest_blob_name(station_name)
+    _remove_stale_reanalysis_partitions(station_name, raw_blobs, manifest)
+    to_process = {
+        name: {"etag": props["etag"], "size": props["size"]}
+        for name, props in raw_blobs.items()
+        if manifest.get(name) != {"etag": props["etag"], "size": props["size"]}
+    }
+    print(f"{len(to_process)} of {len(raw_blobs)} years to process")
+    for blob_name, entry in tqdm(to_process.items()):
         year = int(blob_name.split(".")[0].split("_")[-1])
-        ds = load_glofas_reanalysis_year("raw", station_name, year)
-        da = ds["dis24"]
-        df_in = da.to_dataframe().reset_index()[["time", "dis24"]]
-        dfs.append(df_in)
-    df = pd.concat(dfs, ignore_index=True)
-    df = df.sort_values("time")
-    blob_name = get_blob_name("processed", "reanalysis", station_name)
-    blob.upload_parquet_to_blob(blob_name, df)
+        df = _process_glofas_reanalysis_year(station_name, year)
+        df = df.sort_values("time")
+        blob.upload_parquet_to_blob(
+            get_reanalysis_partition_blob_name(station_name, year), df
+        )
+        manifest[blob_name] = entry
+        blob.upload_blob_data(
+            manifest_blob_name, json.dumps(manifest, indent=2, sort_keys=True)
+        )
+
+
+def _remove_stale_reanalysis_partitions(
+    station_name: str, raw_blobs: dict, manifest: dict
+):
+    """Delete the partitions of years no longer in the raw store, and drop
+    their raw blobs from the manifest, which is updated in place."""
+    raw_years = {int(x.split(".")[0].split("_")[-1]) for x in raw_blobs}
+    partition_dir = get_reanalysis_partition_dir(station_name)
+    for blob_name in blob.blob_metadata(prefix=f"{partition_dir}/year="):
+        year = int(blob_name.split("year=")[1].split("/")[0])
+        if year not in raw_years:
+            print(f"Removing {blob_name}, no longer in the raw store")
+            blob.delete_blob(blob_name)
+    stale = [x for x in manifest if x not in raw_blobs]
+    for blob_name in stale:
+        del manifest[blob_name]
+    if stale:
+        blob.upload_blob_data(
+            get_reanalysis_manifest_blob_name(station_name),
+            json.dumps(manifest, indent=2, sort_keys=True),
+        )
 
 
 def download_glofas_reanalysis_to_blob(station_name: str):
@@ -398,6 +1017,45 @@ def download_glofas_reanalysis_to_blob(station_name: str):
         download_glofas_reanalysis_year_to_blob(year, station_name)
 
 
-def load_glofas_reanalysis(station_name: str):
-    blob_name = get_blob_name("processed", "reanalysis", station_name)
-    return blob.load_parquet_from_blob(blob_name)
+def download_glofas_reanalysis_stations_to_blob(station_names: list):
+    for year in tqdm(range(1979, 2025)):
+        download_glofas_reanalysis_stations_year_to_blob(year, station_names)
+
+
+def load_glofas_reanalysis(
+    station_name: str,
+    partitioned: bool = False,
+    columns: list = None,
+    filters=None,
+):
+    """Load the processed reanalysis for a station.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station in `GF_STATIONS`.
+    partitioned : bool, optional
+        If True, read the year-partitioned output of
+        `process_glofas_reanalysis(..., incremental=True)` instead of the
+        single parquet.
+    columns : list, optional
+        Columns to load, by default `time` and `dis24`.
+    filters : list or pyarrow.dataset.Expression, optional
+        Row filter passed to `blob.read_parquet_dataset`, e.g.
+        `[("time", ">=", pd.Timestamp("2012-07-01")),
+        ("time", "<", pd.Timestamp("2012-11-01"))]`. Only the row groups
+        that can match are downloaded. When `partitioned`, also filter on
+        `year` so that other years' files aren't opened at all.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    if partitioned:
+        prefix = get_reanalysis_partition_dir(station_name)
+    else:
+        prefix = get_blob_name("processed", "reanalysis", station_name)
+    df = blob.read_parquet_dataset(
+        prefix, columns=columns or ["time", "dis24"], filters=filters
+    )
+    return df.sort_values("time", ignore_index=True)
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from src.datasources import glofas
+
+
+def align_with_reanalysis(
+    df_forecast: pd.DataFrame,
+    df_reanalysis: pd.DataFrame,
+    value_col: str = "dis24",
+) -> pd.DataFrame:
+    """Add the reanalysis value at each forecast's valid time.
+
+    Parameters
+    ----------
+    df_forecast : pd.DataFrame
+        Forecasts with a `valid_time` column, such as the output of
+        `glofas.load_reforecast` or `glofas.load_reforecast_ensembles`.
+    df_reanalysis : pd.DataFrame
+        Reanalysis with `time` and `value_col` columns, such as the output
+        of `glofas.load_glofas_reanalysis`.
+    value_col : str, optional
+        Name of the reanalysis value column, by default "dis24".
+
+    Returns
+    -------
+    pd.DataFrame
+        `df_forecast` with an `obs` column, NaN where there is no
+        reanalysis for the valid time.
+    """
+    obs = df_reanalysis.set_index(
+        pd.to_datetime(df_reanalysis["time"]).dt.normalize()
+    )[value_col]
+    obs = obs[~obs.index.duplicated()]
+    df_forecast = df_forecast.copy()
+    df_forecast["obs"] = obs.reindex(
+        pd.to_datetime(df_forecast["valid_time"]).dt.normalize()
+    ).to_numpy()
+    return df_forecast
+
+
+def _count_by_probability(frac, mask, probabilities) -> np.ndarray:
+    """Count, for each (leadtime, threshold), the forecasts in `mask` with
+    an exceedance fraction of at least each probability."""
+    n_forecasts, n_leadtimes, n_thresholds = frac.shape
+    n_bins = len(probabilities) + 1
+    # Number of probabilities each forecast meets or exceeds
+    n_met = np.searchsorted(probabilities, np.nan_to_num(frac), side="right")
+    cell = np.broadcast_to(
+        np.arange(n_leadtimes * n_thresholds).reshape(
+            1, n_leadtimes, n_thresholds
+        ),
+        frac.shape,
+    )
+    counts = np.bincount(
+        (cell * n_bins + n_met)[mask],
+        minlength=n_leadtimes * n_thresholds * n_bins,
+    ).reshape(n_leadtimes, n_thresholds, n_bins)
+    return counts[..., ::-1].cumsum(axis=-1)[..., ::-1][..., 1:]
+
+
+def calculate_skill_scores(
+    df_forecast: pd.DataFrame,
+    df_reanalysis: pd.DataFrame,
+    thresholds,
+    probabilities=None,
+    value_col: str = "dis24",
+) -> xr.Dataset:
+    """Verify reforecasts against reanalysis for many thresholds at once.
+
+    An event is the reanalysis exceeding a threshold at the forecast's
+    valid time. The forecast probability of the event is the fraction of
+    ensemble members exceeding the same threshold (0 or 1 for a
+    deterministic forecast), and the event is forecast when that
+    probability is at least a given probability threshold.
+
+    Contingency counts for every (leadtime, threshold, probability) are
+    found in one pass, by binning each forecast by how many probability
+    thresholds it meets and taking a reverse cumulative sum, so no array of
+    size forecasts x thresholds x probabilities is ever built.
+
+    Parameters
+    ----------
+    df_forecast : pd.DataFrame
+        Forecasts with columns `time`, `leadtime`, `valid_time` and
+        `value_col`, with one row per ensemble member if an ensemble.
+    df_reanalysis : pd.DataFrame
+        Reanalysis with `time` and `value_col` columns.
+    thresholds : array_like
+        Discharge thresholds defining the event.
+    probabilities : array_like, optional
+        Probability thresholds for issuing a forecast, by default 0 to 1 in
+        steps of 0.05. A probability of 0 means always forecasting the
+        event.
+    value_col : str, optional
+        Name of the value column in both inputs, by default "dis24".
+
+    Returns
+    -------
+    xr.Dataset
+        With dimensions (leadtime, threshold, probability): `hits`,
+        `false_alarms`, `misses`, `correct_negatives`, `hit_rate`,
+        `false_alarm_ratio` and `csi`. With dimensions (leadtime,
+        threshold): `n_events`, `n_forecasts` and `brier_score`.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    if probabilities is None:
+        probabilities = np.round(np.arange(0, 1.01, 0.05), 2)
+    probabilities = np.sort(np.asarray(probabilities, dtype=float))
+
+    frac_da = glofas.calculate_exceedance_fractions(
+        df_forecast, thresholds, value_col=value_col
+    )
+    frac = frac_da.to_numpy()
+    df_valid_time = pd.DataFrame(
+        {"valid_time": frac_da["valid_time"].to_numpy().ravel()}
+    )
+    obs_values = (
+        align_with_reanalysis(df_valid_time, df_reanalysis, value_col)["obs"]
+        .to_numpy()
+        .reshape(frac.shape[:2])
+    )
+
+    valid = ~np.isnan(frac) & ~np.isnan(obs_values)[..., None]
+    event = obs_values[..., None] > thresholds
+
+    hits = _count_by_probability(frac, valid & event, probabilities)
+    false_alarms = _count_by_probability(frac, valid & ~event, probabilities)
+    n_events = (valid & event).sum(axis=0)
+    n_forecasts = valid.sum(axis=0)
+    misses = n_events[..., None] - hits
+    correct_negatives = (n_forecasts - n_events)[..., None] - false_alarms
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hit_rate = hits / (hits + misses)
+        false_alarm_ratio = false_alarms / (hits + false_alarms)
+        csi = hits / (hits + misses + false_alarms)
+        brier_score = (
+            np.where(valid, (np.nan_to_num(frac) - event) ** 2, 0).sum(axis=0)
+            / n_forecasts
+        )
+
+    dims = ("leadtime", "threshold", "probability")
+    return xr.Dataset(
+        {
+            "hits": (dims, hits),
+            "false_alarms": (dims, false_alarms),
+            "misses": (dims, misses),
+            "correct_negatives": (dims, correct_negatives),
+            "hit_rate": (dims, hit_rate),
+            "false_alarm_ratio": (dims, false_alarm_ratio),
+            "csi": (dims, csi),
+            "n_events": (dims[:2], n_events),
+            "n_forecasts": (dims[:2], n_forecasts),
+            "brier_score": (dims[:2], brier_score),
+        },
+        coords={
+            "leadtime": frac_da["leadtime"].to_numpy(),
+            "threshold": thresholds,
+            "probability": probabilities,
+        },
+    )
@@ -5,6 +5,7 @@ import pandas as pd
 import rioxarray as rxr
 
 from src.datasources import codab
+from src.utils import raster
 
 AA_DATA_DIR = Path(os.getenv("AA_DATA_DIR_NEW", "."))
 RAW_WP_PATH = (
@@ -25,18 +26,17 @@ def load_raw_worldpop():
 
 def aggregate_worldpop_to_adm2():
     pop = load_raw_worldpop()
+    pop = pop.where(pop > 0)
     adm2 = codab.load_codab(admin_level=2)
-    dicts = []
-    for _, row in adm2.iterrows():
-        da_clip = pop.rio.clip([row.geometry])
-        da_clip = da_clip.where(da_clip > 0)
-        dicts.append(
-            {
-                "total_pop": da_clip.sum().values,
-                "ADM2_PCODE": row["ADM2_PCODE"],
-            }
-        )
-    df_pop = pd.DataFrame(dicts)
+    df = raster.compute_weighted_zonal_stats(
+        pop, adm2, "ADM2_PCODE", stats=("sum",)
+    )
+    df_pop = (
+        df.groupby("ADM2_PCODE", sort=False)["sum"]
+        .sum()
+        .rename("total_pop")
+        .reset_index()[["total_pop", "ADM2_PCODE"]]
+    )
     filename = "nga_adm2_2020_1km_Aggregated_UNadj.csv"
     df_pop.to_csv(PROC_WP_DIR / filename, index=False)
 
@@ -3,7 +3,6 @@ from datetime import timedelta
 import ocha_stratus as stratus
 import pandas as pd
 import requests
-import xarray as xr
 from dotenv import load_dotenv
 from sqlalchemy import text
 
@@ -13,8 +12,8 @@ from src.constants import (
     GOOGLE_THRESH,
     GOOGLE_WARNING_THRESH,
 )
-from src.datasources import grrr
-from src.utils import cds_utils
+from src.datasources import glofas, grrr
+from src.utils import blob, blob_cache, cds_utils
 
 load_dotenv()
 
@@ -29,22 +28,8 @@ def get_blob_name(data_type, station_name, date):
     return f"ds-aa-nga-flooding/raw/glofas/monitoring/{filename}"
 
 
-def get_glofas_forecast(
-    forecast_blob_name,
-    coords,
-    issued_date,
-    keep_local_copy=True,
-    overwrite=False,
-):
-    container = stratus.get_container_client("projects", "dev")
-    if (
-        container.get_blob_client(forecast_blob_name).exists()
-        and not overwrite
-    ):
-        print(f"File already exists: {forecast_blob_name}. Skipping download")
-        return
-    forecast_dataset = "cems-glofas-forecast"
-    forecast_request = {
+def _get_forecast_request(issued_date) -> dict:
+    return {
         "system_version": ["operational"],
         "hydrological_model": ["lisflood"],
         "product_type": ["ensemble_perturbed_forecasts"],
@@ -61,9 +46,36 @@ def get_glofas_forecast(
         ],
         "data_format": "grib2",
         "download_format": "unarchived",
-        "area": coords,
     }
 
+
+def _get_reanalysis_request(issued_date) -> dict:
+    return {
+        "system_version": ["version_4_0"],
+        "hydrological_model": ["lisflood"],
+        "product_type": ["intermediate"],
+        "variable": ["river_discharge_in_the_last_24_hours"],
+        "hyear": [str(issued_date.year)],
+        "hmonth": [str(issued_date.month).zfill(2)],
+        "hday": [str(issued_date.day).zfill(2)],
+        "data_format": "grib2",
+        "download_format": "unarchived",
+    }
+
+
+def get_glofas_forecast(
+    forecast_blob_name,
+    coords,
+    issued_date,
+    keep_local_copy=True,
+    overwrite=False,
+):
+    if not overwrite and blob.existing_blobs([forecast_blob_name]):
+        print(f"File already exists: {forecast_blob_name}. Skipping download")
+        return
+    forecast_dataset = "cems-glofas-forecast"
+    forecast_request = {**_get_forecast_request(issued_date), "area": coords}
+
     cds_utils.download_raw_cds_api_to_blob(
         forecast_dataset,
         forecast_request,
@@ -79,26 +91,14 @@ def get_glofas_reanalysis(
     keep_local_copy=True,
     overwrite=False,
 ):
-    container = stratus.get_container_client("projects", "dev")
-    if (
-        container.get_blob_client(reanalysis_blob_name).exists()
-        and not overwrite
-    ):
+    if not overwrite and blob.existing_blobs([reanalysis_blob_name]):
         print(
             f"File already exists: {reanalysis_blob_name}. Skipping download"
         )
         return
     reanalysis_dataset = "cems-glofas-historical"
     reanalysis_request = {
-        "system_version": ["version_4_0"],
-        "hydrological_model": ["lisflood"],
-        "product_type": ["intermediate"],
-        "variable": ["river_discharge_in_the_last_24_hours"],
-        "hyear": [str(issued_date.year)],
-        "hmonth": [str(issued_date.month).zfill(2)],
-        "hday": [str(issued_date.day).zfill(2)],
-        "data_format": "grib2",
-        "download_format": "unarchived",
+        **_get_reanalysis_request(issued_date),
         "area": coords,
     }
     cds_utils.download_raw_cds_api_to_blob(
@@ -109,6 +109,68 @@ def get_glofas_reanalysis(
     )
 
 
+def _get_missing_blob_names(blob_names, overwrite):
+    if overwrite:
+        return blob_names
+    existing = blob.existing_blobs(blob_names.values())
+    missing = {}
+    for station_name, blob_name in blob_names.items():
+        if blob_name in existing:
+            print(f"File already exists: {blob_name}. Skipping download")
+        else:
+            missing[station_name] = blob_name
+    return missing
+
+
+def get_glofas_forecast_stations(
+    station_names,
+    issued_date,
+    keep_local_copy=True,
+    overwrite=False,
+):
+    """Download the forecast for several stations with a single CDS
+    request, saving one blob per station under `get_blob_name`."""
+    blob_names = _get_missing_blob_names(
+        {x: get_blob_name("forecast", x, issued_date) for x in station_names},
+        overwrite,
+    )
+    if not blob_names:
+        return
+    glofas.download_glofas_stations_to_blob(
+        "cems-glofas-forecast",
+        _get_forecast_request(issued_date),
+        blob_names,
+        keep_local_copy=keep_local_copy,
+    )
+
+
+def get_glofas_reanalysis_stations(
+    station_names,
+    monitoring_date,
+    reanalysis_date,
+    keep_local_copy=True,
+    overwrite=False,
+):
+    """Download the reanalysis for several stations with a single CDS
+    request. As with `get_glofas_reanalysis`, blobs are named by the
+    monitoring date rather than the date the reanalysis is valid for."""
+    blob_names = _get_missing_blob_names(
+        {
+            x: get_blob_name("reanalysis", x, monitoring_date)
+            for x in station_names
+        },
+        overwrite,
+    )
+    if not blob_names:
+        return
+    glofas.download_glofas_stations_to_blob(
+        "cems-glofas-historical",
+        _get_reanalysis_request(reanalysis_date),
+        blob_names,
+        keep_local_copy=keep_local_copy,
+    )
+
+
 def get_google_forecast(hybas_id, issued_date):
     res = requests.get(
         "https://floodforecasting.googleapis.com/v1/gauges:queryGaugeForecasts",  # noqa
@@ -150,25 +212,19 @@ def get_google_forecast(hybas_id, issued_date):
 
 
 def process_glofas(blob_name, data_type, station_name):
-    ds = xr.open_dataset(
-        f"temp/{blob_name}",
-        engine="cfgrib",
-        decode_timedelta=True,
-        backend_kwargs={
-            "indexpath": "",
-        },
+    station = glofas.GF_STATIONS[station_name]
+    lon, lat = glofas.get_glofas_grid_coords(station["lon"], station["lat"])
+    df = glofas.read_grib_points(
+        blob_cache.get_cached_blob_path(blob_name), {station_name: (lon, lat)}
     )
     # Take the ensemble mean if forecast
     if data_type == "glofas_forecast":
-        ds = ds["dis24"].mean(dim="number")
-    df = (
-        ds.assign_coords(valid_time=ds["valid_time"] - pd.Timedelta(hours=24))
-        .to_dataframe()
-        .reset_index()
+        df = df.groupby(["time", "step"], as_index=False)["value"].mean()
+    df["valid_date"] = pd.to_datetime(
+        df["time"] + df["step"] - pd.Timedelta(hours=24)
     )
-    df["valid_date"] = pd.to_datetime(df["valid_time"])
     df["src"] = f"{data_type}_{station_name}"
-    df = df.rename(columns={"dis24": "value", "time": "issued_date"})
+    df = df.rename(columns={"time": "issued_date"})
     return df[["issued_date", "valid_date", "value", "src"]]
 
 
@@ -2,11 +2,11 @@ import io
 
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
-import ocha_stratus as stratus
 import pandas as pd
 from matplotlib.ticker import FuncFormatter
 
 from src.constants import PROJECT_PREFIX
+from src.utils import blob
 
 
 def combined_plots(df, glofas_thresh, google_thresh, save_output=True):
@@ -53,16 +53,10 @@ def combined_plots(df, glofas_thresh, google_thresh, save_output=True):
         buffer = io.BytesIO()
         plt.savefig(buffer, format="png", bbox_inches="tight", dpi=300)
         buffer.seek(0)
-        container_client = stratus.get_container_client(
-            "projects", "dev", write=True
-        )
         blob_name = (
             f"{PROJECT_PREFIX}/monitoring/{update_date}_{overall_exceeds}.png"
         )
-
-        container_client.upload_blob(
-            name=blob_name, data=buffer.getvalue(), overwrite=True
-        )
+        blob.upload_blob_data(blob_name, buffer.getvalue(), prod_dev="dev")
         print(f"File saved on blob to {blob_name}!")
         buffer.close()
 
@@ -3,11 +3,11 @@ import re
 import smtplib
 import ssl
 
-import ocha_stratus as stratus
 import pandas as pd
 from dotenv import load_dotenv
 
 from src.constants import PROJECT_PREFIX
+from src.utils import blob
 
 load_dotenv()
 
@@ -47,7 +47,7 @@ def get_distribution_list(test_list) -> pd.DataFrame:
         blob_name = f"{PROJECT_PREFIX}/email/test_distribution_list.csv"
     else:
         blob_name = f"{PROJECT_PREFIX}/email/distribution_list.csv"
-    return stratus.load_csv_from_blob(blob_name)
+    return blob.load_csv_from_blob(blob_name)
 
 
 def is_valid_email(email):
@@ -1,108 +1,580 @@
+import collections
+import functools
 import io
 import os
-import shutil
 import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import geopandas as gpd
 import ocha_stratus as stratus
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+import requests
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import ContainerClient
 
-prod_container_client = stratus.get_container_client(
-    container_name="aa-data", stage="prod"
-)
-dev_container_client = stratus.get_container_client(
-    container_name="projects", stage="dev"
-)
+from src.utils import local_blob
+
+CONTAINER_NAMES = {"prod": "aa-data", "dev": "projects"}
+# "azure", or "local" for containers in folders under AA_BLOB_LOCAL_DIR, see
+# `local_blob.LocalContainerClient`
+BLOB_BACKEND = os.getenv("AA_BLOB_BACKEND", "azure")
+# Maximum number of pooled HTTP connections shared by all container clients
+BLOB_POOL_SIZE = int(os.getenv("AA_BLOB_POOL_SIZE", 16))
+# Number of ranges downloaded at once, and their size in bytes
+BLOB_MAX_CONCURRENCY = int(os.getenv("AA_BLOB_MAX_CONCURRENCY", 8))
+BLOB_CHUNK_SIZE = int(os.getenv("AA_BLOB_CHUNK_SIZE", 4 * 1024**2))
+# Seconds that a listing is reused for by `blob_metadata`
+BLOB_METADATA_TTL = float(os.getenv("AA_BLOB_METADATA_TTL", 60))
+# Most names in a folder that `existing_blobs` checks one by one, rather
+# than listing
+EXISTS_CHECK_MAX_NAMES = 4
+# Most files whose size and footer `BlobFileSystemHandler` remembers
+BLOB_FS_CACHE_SIZE = 1024
+# Features per row group in GeoParquet, so bbox reads can skip row groups
+GDF_ROW_GROUP_SIZE = 10_000
+
+
+@functools.lru_cache(maxsize=None)
+def get_transport() -> RequestsTransport:
+    """Get the HTTP transport shared by all container clients, so that
+    connections are pooled and reused across calls."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=BLOB_POOL_SIZE, pool_maxsize=BLOB_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_container_client(
+    prod_dev: Literal["prod", "dev"] = "dev", write: bool = False
+):
+    """Get the container client for a stage.
+
+    Clients are created on first use rather than on import, and then cached,
+    so modules that import this one but never touch blob storage don't pay
+    for building them. With `BLOB_BACKEND` set to "local", the container is
+    a local folder instead. Pass `write=True` for a client that can upload
+    and delete blobs.
+    """
+    if BLOB_BACKEND == "local":
+        return local_blob.LocalContainerClient(
+            local_blob.BLOB_LOCAL_DIR / CONTAINER_NAMES[prod_dev]
+        )
+    if BLOB_BACKEND != "azure":
+        raise ValueError(f"Invalid blob backend: {BLOB_BACKEND}")
+    client = stratus.get_container_client(
+        container_name=CONTAINER_NAMES[prod_dev], stage=prod_dev, write=write
+    )
+    # Rebuilt over the shared transport, keeping both a SAS token in the URL
+    # and any credential the client was created with
+    return ContainerClient.from_container_url(
+        client.url, credential=client.credential, transport=get_transport()
+    )
+
+
+class BlobReader(io.RawIOBase):
+    """Seekable, read-only file object over a blob.
+
+    Reads are served with ranged downloads, split into `chunk_size` pieces
+    fetched `max_concurrency` at a time. With `readahead`, reads are aligned
+    to chunks and the next `max_concurrency` chunks are prefetched, which
+    suits readers that go through a file from start to end (CSV, Excel).
+    Without it, only the bytes asked for are downloaded, which suits
+    readers that jump around (e.g. reading a parquet footer and then only
+    the column chunks needed). Reads that run to the end of the blob are
+    kept in `tail_cache` if given, so a footer read when inspecting a file
+    isn't downloaded again when the same file is scanned.
+    """
+
+    def __init__(
+        self,
+        blob_client,
+        size: int = None,
+        chunk_size: int = None,
+        max_concurrency: int = None,
+        readahead: bool = False,
+        tail_cache: dict = None,
+    ):
+        self._blob_client = blob_client
+        self._size = (
+            blob_client.get_blob_properties().size if size is None else size
+        )
+        self._chunk_size = chunk_size or BLOB_CHUNK_SIZE
+        self._max_concurrency = max_concurrency or BLOB_MAX_CONCURRENCY
+        self._readahead = readahead
+        self._tail_cache = tail_cache
+        self._pos = 0
+        self._chunks = {}
+        self._executor = ThreadPoolExecutor(self._max_concurrency)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(cancel_futures=True)
+            self._chunks = {}
+        super().close()
+
+    def _download(self, start: int, end: int) -> bytes:
+        return self._blob_client.download_blob(
+            offset=start, length=end - start
+        ).readall()
+
+    def readinto(self, b) -> int:
+        start = min(self._pos, self._size)
+        end = min(start + len(b), self._size)
+        if start == end:
+            return 0
+        if self._readahead:
+            data = self._read_chunks(start, end)
+        elif self._tail_cache is not None and end == self._size:
+            if start not in self._tail_cache:
+                self._tail_cache[start] = self._download(start, end)
+            data = self._tail_cache[start]
+        else:
+            starts = range(start, end, self._chunk_size)
+            data = b"".join(
+                self._executor.map(
+                    lambda x: self._download(
+                        x, min(x + self._chunk_size, end)
+                    ),
+                    starts,
+                )
+            )
+        n = len(data)
+        b[:n] = data
+        self._pos = start + n
+        return n
+
+    def _read_chunks(self, start: int, end: int) -> bytes:
+        first = start // self._chunk_size
+        last = (end - 1) // self._chunk_size
+        n_chunks = -(-self._size // self._chunk_size)
+        wanted = range(
+            first, min(last + self._max_concurrency, n_chunks - 1) + 1
+        )
+        # Drop chunks we've moved past, then fetch what's missing
+        self._chunks = {i: x for i, x in self._chunks.items() if i in wanted}
+        for i in wanted:
+            if i not in self._chunks:
+                chunk_start = i * self._chunk_size
+                self._chunks[i] = self._executor.submit(
+                    self._download,
+                    chunk_start,
+                    min(chunk_start + self._chunk_size, self._size),
+                )
+        data = b"".join(
+            self._chunks[i].result() for i in range(first, last + 1)
+        )
+        offset = start - first * self._chunk_size
+        return data[offset : offset + end - start]
+
+
+def open_blob(
+    blob_name,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    readahead: bool = True,
+    max_concurrency: int = None,
+):
+    """Open a blob as a seekable binary file.
+
+    See `BlobReader` for how reads are downloaded. With `readahead`, the
+    reader is wrapped in a buffer so that small sequential reads don't each
+    turn into a request.
+    """
+    blob_client = get_container_client(prod_dev).get_blob_client(blob_name)
+    reader = BlobReader(
+        blob_client, max_concurrency=max_concurrency, readahead=readahead
+    )
+    if readahead:
+        return io.BufferedReader(reader, buffer_size=1024**2)
+    return reader
 
 
 def load_csv_from_blob(
     blob_name, prod_dev: Literal["prod", "dev"] = "dev", **kwargs
 ):
-    blob_data = load_blob_data(blob_name, prod_dev=prod_dev)
-    return pd.read_csv(io.BytesIO(blob_data), **kwargs)
+    with open_blob(blob_name, prod_dev=prod_dev) as f:
+        return pd.read_csv(f, **kwargs)
 
 
 def load_excel_from_blob(
     blob_name, prod_dev: Literal["prod", "dev"] = "dev", **kwargs
 ):
-    blob_data = load_blob_data(blob_name, prod_dev=prod_dev)
-    return pd.read_excel(io.BytesIO(blob_data), **kwargs)
+    with open_blob(blob_name, prod_dev=prod_dev) as f:
+        return pd.read_excel(f, **kwargs)
 
 
 def load_parquet_from_blob(
-    blob_name, prod_dev: Literal["prod", "dev"] = "dev"
+    blob_name, prod_dev: Literal["prod", "dev"] = "dev", columns=None
 ):
-    blob_data = load_blob_data(blob_name, prod_dev=prod_dev)
-    return pd.read_parquet(io.BytesIO(blob_data))
+    """Load a parquet blob. If `columns` is given, only the footer and
+    those columns' chunks are downloaded."""
+    with open_blob(blob_name, prod_dev=prod_dev, readahead=False) as f:
+        return pd.read_parquet(f, columns=columns)
 
 
-def upload_gdf_to_blob(
-    gdf, blob_name, prod_dev: Literal["prod", "dev"] = "dev"
-):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # File paths for shapefile components within the temp directory
-        shp_base_path = os.path.join(temp_dir, "data")
+class _LRUDict(collections.OrderedDict):
+    """Dict that keeps only its `maxsize` most recently used items."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class BlobFileSystemHandler(pafs.FileSystemHandler):
+    """Read-only pyarrow filesystem over a blob container.
 
-        gdf.to_file(shp_base_path, driver="ESRI Shapefile")
+    Blob names are paths, and any prefix ending in "/" that has blobs under
+    it is a directory. Files are opened as `BlobReader`s without readahead,
+    so pyarrow's parquet reader only downloads the ranges it asks for. Use
+    through `pafs.PyFileSystem(BlobFileSystemHandler(...))`.
+    """
 
-        zip_file_path = os.path.join(temp_dir, "data")
+    def __init__(self, container_client):
+        self._container_client = container_client
+        # Sizes seen when listing, so opening a listed file needs no
+        # extra request for its properties, and footers read, for the most
+        # recently used files
+        self._sizes = _LRUDict(BLOB_FS_CACHE_SIZE)
+        self._tails = _LRUDict(BLOB_FS_CACHE_SIZE)
 
-        shutil.make_archive(
-            base_name=zip_file_path, format="zip", root_dir=temp_dir
+    def get_type_name(self):
+        return "azure-blob"
+
+    def normalize_path(self, path):
+        return path.strip("/")
+
+    def equals(self, other):
+        return (
+            isinstance(other, BlobFileSystemHandler)
+            and other._container_client is self._container_client
         )
 
-        # Define the full path to the zip file
-        full_zip_path = f"{zip_file_path}.zip"
+    def _get_file_info(self, path):
+        path = self.normalize_path(path)
+        if path in self._sizes:
+            return pafs.FileInfo(
+                path, pafs.FileType.File, size=self._sizes[path]
+            )
+        try:
+            properties = self._container_client.get_blob_client(
+                path
+            ).get_blob_properties()
+        except ResourceNotFoundError:
+            blobs = self._container_client.list_blobs(
+                name_starts_with=path + "/"
+            )
+            if next(iter(blobs), None) is not None:
+                return pafs.FileInfo(path, pafs.FileType.Directory)
+            return pafs.FileInfo(path, pafs.FileType.NotFound)
+        self._sizes[path] = properties.size
+        return pafs.FileInfo(path, pafs.FileType.File, size=properties.size)
 
-        # Upload the buffer content as a blob
-        with open(full_zip_path, "rb") as data:
-            upload_blob_data(blob_name, data, prod_dev=prod_dev)
+    def get_file_info(self, paths):
+        return [self._get_file_info(x) for x in paths]
 
+    def get_file_info_selector(self, selector):
+        base_dir = self.normalize_path(selector.base_dir)
+        prefix = base_dir + "/" if base_dir else ""
+        infos = {}
+        for blob in self._container_client.list_blobs(name_starts_with=prefix):
+            self._sizes[blob.name] = blob.size
+            parts = blob.name[len(prefix) :].split("/")
+            n_dirs = len(parts) - 1 if selector.recursive else 1
+            # Directories are implied by the blob names below them
+            for i in range(1, min(n_dirs, len(parts) - 1) + 1):
+                name = prefix + "/".join(parts[:i])
+                infos[name] = pafs.FileInfo(name, pafs.FileType.Directory)
+            if selector.recursive or len(parts) == 1:
+                infos[blob.name] = pafs.FileInfo(
+                    blob.name, pafs.FileType.File, size=blob.size
+                )
+        if not infos and not selector.allow_not_found:
+            raise FileNotFoundError(selector.base_dir)
+        return list(infos.values())
 
-def load_gdf_from_blob(
-    blob_name, shapefile: str = None, prod_dev: Literal["prod", "dev"] = "dev"
+    def open_input_file(self, path):
+        path = self.normalize_path(path)
+        if path not in self._tails:
+            self._tails[path] = {}
+        reader = BlobReader(
+            self._container_client.get_blob_client(path),
+            size=self._sizes.get(path),
+            tail_cache=self._tails[path],
+        )
+        return pa.PythonFile(reader, mode="r")
+
+    def open_input_stream(self, path):
+        return self.open_input_file(path)
+
+    def _read_only(self, *args, **kwargs):
+        raise PermissionError("read-only filesystem")
+
+    create_dir = delete_dir = delete_dir_contents = _read_only
+    delete_root_dir_contents = delete_file = move = copy_file = _read_only
+    open_output_stream = open_append_stream = _read_only
+
+
+def get_filesystem(prod_dev: Literal["prod", "dev"] = "dev"):
+    """Get a pyarrow filesystem over the container for a stage."""
+    return pafs.PyFileSystem(
+        BlobFileSystemHandler(get_container_client(prod_dev))
+    )
+
+
+def read_parquet_dataset(
+    prefix,
+    columns=None,
+    filters=None,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    filesystem=None,
+) -> pd.DataFrame:
+    """Read a parquet blob, or the hive-partitioned parquet blobs under a
+    prefix, downloading only what the query needs.
+
+    Partitions are pruned by their keys, then the footers of the remaining
+    files are read and row groups whose statistics can't match `filters`
+    are skipped. Only the chunks of `columns` in the surviving row groups
+    are downloaded.
+
+    Parameters
+    ----------
+    prefix : str
+        Name of a parquet blob, or a blob prefix treated as a directory.
+    columns : list of str, optional
+        Columns to read, by default all, including partition keys.
+    filters : list or pyarrow.dataset.Expression, optional
+        Row filter, as an expression or in the list of tuples form accepted
+        by `pyarrow.parquet.read_table`, e.g.
+        `[("time", ">=", pd.Timestamp("2012-07-01"))]`.
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to read from, by default "dev".
+    filesystem : pyarrow.fs.FileSystem, optional
+        Filesystem to read from instead of the container, e.g. a
+        `pafs.SubTreeFileSystem` over a local directory laid out like it.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    if filesystem is None:
+        filesystem = get_filesystem(prod_dev)
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    dataset = ds.dataset(
+        prefix.strip("/"),
+        filesystem=filesystem,
+        format="parquet",
+        partitioning="hive",
+    )
+    table = dataset.to_table(columns=columns, filter=filters)
+    return table.to_pandas()
+
+
+def _get_gdf_format(blob_name, file_format=None):
+    if file_format is not None:
+        return file_format
+    return "parquet" if blob_name.endswith(".parquet") else "shapefile"
+
+
+def upload_gdf_to_blob(
+    gdf,
+    blob_name,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    file_format: Literal["shapefile", "parquet"] = None,
 ):
-    blob_data = load_blob_data(blob_name, prod_dev=prod_dev)
-    with zipfile.ZipFile(io.BytesIO(blob_data), "r") as zip_ref:
-        zip_ref.extractall("temp")
+    """Upload a GeoDataFrame as a zipped shapefile or as GeoParquet.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+    blob_name : str
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to upload to, by default "dev".
+    file_format : Literal["shapefile", "parquet"], optional
+        By default GeoParquet if `blob_name` ends with ".parquet", else a
+        zipped shapefile. GeoParquet is written with a bbox covering column,
+        so `load_gdf_from_blob(..., bbox=...)` can skip row groups.
+    """
+    if _get_gdf_format(blob_name, file_format) == "parquet":
+        buffer = io.BytesIO()
+        gdf.to_parquet(
+            buffer,
+            write_covering_bbox=True,
+            schema_version="1.1.0",
+            row_group_size=GDF_ROW_GROUP_SIZE,
+        )
+        upload_blob_data(blob_name, buffer.getvalue(), prod_dev=prod_dev)
+        return
+    # The shapefile driver can't write to memory, as it writes several
+    # files, so write to a private directory and zip into memory from there
+    buffer = io.BytesIO()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gdf.to_file(os.path.join(temp_dir, "data.shp"))
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+            for filename in sorted(os.listdir(temp_dir)):
+                zip_ref.write(os.path.join(temp_dir, filename), filename)
+    upload_blob_data(blob_name, buffer.getvalue(), prod_dev=prod_dev)
+
+
+def _read_zipped_shapefile(data: bytes, shapefile: str = None, **kwargs):
+    """Read a shapefile from zip archive bytes without extracting to disk.
+
+    The files making up the shapefile are copied into a small zip in
+    memory, which GDAL reads through a virtual zip path.
+    """
+    with zipfile.ZipFile(io.BytesIO(data), "r") as zip_ref:
+        names = zip_ref.namelist()
         if shapefile is None:
-            shapefile = [f for f in zip_ref.namelist() if f.endswith(".shp")][
-                0
-            ]
-        gdf = gpd.read_file(f"temp/{shapefile}")
-    return gdf
+            shapefile = [f for f in names if f.endswith(".shp")][0]
+        stem = os.path.splitext(shapefile)[0]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as shp_zip:
+            for name in names:
+                if os.path.splitext(name)[0] == stem:
+                    shp_zip.writestr(
+                        os.path.basename(name), zip_ref.read(name)
+                    )
+    buffer.seek(0)
+    return gpd.read_file(buffer, **kwargs)
+
+
+def load_gdf_from_blob(
+    blob_name,
+    shapefile: str = None,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    file_format: Literal["shapefile", "parquet"] = None,
+    bbox: tuple = None,
+    columns: list = None,
+):
+    """Load a GeoDataFrame from a zipped shapefile or GeoParquet blob.
+
+    Parameters
+    ----------
+    blob_name : str
+    shapefile : str, optional
+        Path of the shapefile within the zip, by default the first one.
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to load from, by default "dev".
+    file_format : Literal["shapefile", "parquet"], optional
+        By default GeoParquet if `blob_name` ends with ".parquet", else a
+        zipped shapefile.
+    bbox : tuple, optional
+        (minx, miny, maxx, maxy) to only load features intersecting it. For
+        GeoParquet with a bbox covering column, only the row groups that
+        can intersect it are downloaded.
+    columns : list, optional
+        Columns to load, by default all.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+    """
+    if _get_gdf_format(blob_name, file_format) == "parquet":
+        return gpd.read_parquet(
+            blob_name,
+            columns=columns,
+            bbox=bbox,
+            filesystem=get_filesystem(prod_dev),
+        )
+    return _read_zipped_shapefile(
+        load_blob_data(blob_name, prod_dev=prod_dev),
+        shapefile=shapefile,
+        bbox=bbox,
+        columns=columns,
+    )
 
 
 def load_blob_data(blob_name, prod_dev: Literal["prod", "dev"] = "dev"):
-    if prod_dev == "dev":
-        container_client = dev_container_client
-    else:
-        container_client = prod_container_client
+    container_client = get_container_client(prod_dev)
     blob_client = container_client.get_blob_client(blob_name)
-    data = blob_client.download_blob().readall()
+    data = blob_client.download_blob(
+        max_concurrency=BLOB_MAX_CONCURRENCY
+    ).readall()
     return data
 
 
+def get_blob_properties(blob_name, prod_dev: Literal["prod", "dev"] = "dev"):
+    """Get the ETag and size of a blob."""
+    container_client = get_container_client(prod_dev)
+    properties = container_client.get_blob_client(
+        blob_name
+    ).get_blob_properties()
+    return {"etag": properties.etag, "size": properties.size}
+
+
+def download_blob_to_file(
+    blob_name, file, prod_dev: Literal["prod", "dev"] = "dev"
+):
+    """Stream a blob into an open binary file."""
+    container_client = get_container_client(prod_dev)
+    blob_client = container_client.get_blob_client(blob_name)
+    blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY).readinto(
+        file
+    )
+
+
 def upload_blob_data(
     blob_name, data, prod_dev: Literal["prod", "dev"] = "dev"
 ):
-    if prod_dev == "dev":
-        container_client = dev_container_client
-    else:
-        container_client = prod_container_client
+    container_client = get_container_client(prod_dev, write=True)
     blob_client = container_client.get_blob_client(blob_name)
     blob_client.upload_blob(data, overwrite=True)
+    invalidate_blob_metadata(blob_name, prod_dev=prod_dev)
+
+
+def delete_blob(blob_name, prod_dev: Literal["prod", "dev"] = "dev"):
+    container_client = get_container_client(prod_dev, write=True)
+    container_client.delete_blob(blob_name)
+    invalidate_blob_metadata(blob_name, prod_dev=prod_dev)
 
 
 def list_container_blobs(
     name_starts_with=None, prod_dev: Literal["prod", "dev"] = "dev"
 ):
-    if prod_dev == "dev":
-        container_client = dev_container_client
-    else:
-        container_client = prod_container_client
+    container_client = get_container_client(prod_dev)
     return [
         blob.name
         for blob in container_client.list_blobs(
@@ -111,6 +583,139 @@ def list_container_blobs(
     ]
 
 
+# Recent listings, as (stage, prefix) -> (monotonic time listed, metadata)
+_metadata_cache = {}
+_metadata_lock = threading.Lock()
+
+
+def blob_metadata(
+    prefix=None,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    max_age: float = None,
+):
+    """Get the ETag, size and last modified time of blobs under a prefix.
+
+    The answer comes from one paged listing. Listings are kept for
+    `max_age` seconds, and a listing of a prefix also answers queries for
+    any longer prefix, so repeated lookups in a loop don't each go to
+    storage. Uploads through this module drop the listings they affect.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        Only list blobs whose name starts with this prefix.
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to list, by default "dev".
+    max_age : float, optional
+        Oldest listing in seconds to reuse, by default `BLOB_METADATA_TTL`.
+        Set to 0 to always list.
+
+    Returns
+    -------
+    dict
+        Mapping of blob name to a dict with keys `etag`, `size` and
+        `last_modified`.
+    """
+    prefix = prefix or ""
+    cached = _get_cached_metadata(prefix, prod_dev, max_age)
+    if cached is not None:
+        return cached
+    now = time.monotonic()
+    container_client = get_container_client(prod_dev)
+    metadata = {
+        blob.name: {
+            "etag": blob.etag,
+            "size": blob.size,
+            "last_modified": blob.last_modified,
+        }
+        for blob in container_client.list_blobs(name_starts_with=prefix)
+    }
+    with _metadata_lock:
+        _metadata_cache[(prod_dev, prefix)] = (now, metadata)
+    return {name: dict(props) for name, props in metadata.items()}
+
+
+def _get_cached_metadata(prefix, prod_dev, max_age):
+    """Answer `blob_metadata` from a recent listing, or None if there is
+    none."""
+    max_age = BLOB_METADATA_TTL if max_age is None else max_age
+    now = time.monotonic()
+    with _metadata_lock:
+        for (stage, cached_prefix), (
+            listed_at,
+            metadata,
+        ) in _metadata_cache.items():
+            if (
+                stage == prod_dev
+                and prefix.startswith(cached_prefix)
+                and now - listed_at <= max_age
+            ):
+                return {
+                    name: dict(props)
+                    for name, props in metadata.items()
+                    if name.startswith(prefix)
+                }
+    return None
+
+
+def invalidate_blob_metadata(
+    blob_name, prod_dev: Literal["prod", "dev"] = "dev"
+):
+    """Drop cached listings that would include `blob_name`. Call after
+    writing a blob other than through this module."""
+    with _metadata_lock:
+        for key in list(_metadata_cache):
+            stage, prefix = key
+            if stage == prod_dev and blob_name.startswith(prefix):
+                del _metadata_cache[key]
+
+
+def existing_blobs(
+    blob_names, prod_dev: Literal["prod", "dev"] = "dev", max_age=None
+) -> set:
+    """Find which of many blobs exist, with at most one listing per folder.
+
+    Recent listings are reused. Otherwise a folder with only a few of the
+    names is checked blob by blob, and one with more is listed, from the
+    longest prefix the names share, so a check of one blob in a large
+    folder doesn't list the folder.
+
+    Parameters
+    ----------
+    blob_names : iterable of str
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to check, by default "dev".
+    max_age : float, optional
+        Passed to `blob_metadata`.
+
+    Returns
+    -------
+    set
+        The names in `blob_names` that exist.
+    """
+    by_folder = {}
+    for blob_name in blob_names:
+        folder = blob_name.rpartition("/")[0]
+        by_folder.setdefault(folder + "/" if folder else "", []).append(
+            blob_name
+        )
+    existing = set()
+    for names in by_folder.values():
+        prefix = os.path.commonprefix(names)
+        metadata = _get_cached_metadata(prefix, prod_dev, max_age)
+        if metadata is None and len(names) <= EXISTS_CHECK_MAX_NAMES:
+            existing.update(
+                x for x in names if check_blob_exists(x, prod_dev=prod_dev)
+            )
+            continue
+        if metadata is None:
+            metadata = blob_metadata(
+                prefix, prod_dev=prod_dev, max_age=max_age
+            )
+        existing.update(x for x in names if x in metadata)
+    return existing
+
+
 def upload_parquet_to_blob(
     blob_name,
     df,
@@ -125,9 +730,6 @@ def upload_parquet_to_blob(
 
 
 def check_blob_exists(blob_name, prod_dev: Literal["prod", "dev"] = "dev"):
-    if prod_dev == "dev":
-        container_client = dev_container_client
-    else:
-        container_client = prod_container_client
+    container_client = get_container_client(prod_dev)
     blob_client = container_client.get_blob_client(blob_name)
     return blob_client.exists()
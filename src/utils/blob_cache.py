@@ -0,0 +1,118 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Literal
+
+from src.utils import blob
+
+BLOB_CACHE_DIR = Path(os.getenv("AA_BLOB_CACHE_DIR", "temp/blob_cache"))
+# Default budget of 5 GB
+BLOB_CACHE_MAX_BYTES = int(os.getenv("AA_BLOB_CACHE_MAX_BYTES", 5 * 1024**3))
+
+
+@contextmanager
+def _file_lock(lock_path: Path, blocking: bool = True):
+    """Hold an exclusive lock on `lock_path`, yielding whether it was taken
+    (always, if `blocking`). Lock files are never removed, as a process can
+    still hold a lock on one after it is unlinked while another locks a new
+    file at the same path."""
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(
+                lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+            )
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_lock_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.lock")
+
+
+def get_cache_path(blob_name: str, etag: str, prod_dev: str = "dev") -> Path:
+    key = hashlib.sha256(f"{prod_dev}/{blob_name}@{etag}".encode()).hexdigest()
+    return BLOB_CACHE_DIR / f"{key}{Path(blob_name).suffix}"
+
+
+def get_cached_blob_path(
+    blob_name: str, prod_dev: Literal["prod", "dev"] = "dev"
+) -> Path:
+    """Get a local copy of a blob, downloading it only if needed.
+
+    Files are cached under `BLOB_CACHE_DIR`, keyed by blob name and ETag,
+    so a blob that has changed is downloaded again and an unchanged one is
+    reused across runs. Downloads are written to a temporary file and
+    renamed into place under a file lock, so concurrent processes never see
+    a partial file or download the same blob twice. Once the cache grows
+    beyond `BLOB_CACHE_MAX_BYTES`, the least recently used files are
+    removed.
+
+    Parameters
+    ----------
+    blob_name : str
+        Name of the blob.
+    prod_dev : Literal["prod", "dev"], optional
+        Which container to read from, by default "dev".
+
+    Returns
+    -------
+    Path
+        Path to the cached file.
+    """
+    etag = blob.get_blob_properties(blob_name, prod_dev=prod_dev)["etag"]
+    path = get_cache_path(blob_name, etag, prod_dev=prod_dev)
+    if path.exists():
+        os.utime(path)
+        return path
+    BLOB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with _file_lock(_get_lock_path(path)):
+        if not path.exists():
+            print(f"Downloading {blob_name} to {path}")
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            try:
+                with open(tmp_path, "wb") as f:
+                    blob.download_blob_to_file(blob_name, f, prod_dev=prod_dev)
+                os.replace(tmp_path, path)
+            finally:
+                if tmp_path.exists():
+                    os.remove(tmp_path)
+    evict_cache(keep=path)
+    return path
+
+
+def evict_cache(max_bytes: int = None, keep: Path = None):
+    """Remove the least recently used files until the cache fits within
+    `max_bytes` (by default `BLOB_CACHE_MAX_BYTES`). `keep`, and files
+    another process holds the lock of, are never removed."""
+    if max_bytes is None:
+        max_bytes = BLOB_CACHE_MAX_BYTES
+    files = []
+    for path in BLOB_CACHE_DIR.iterdir():
+        if path.name.startswith(".") or path.suffix == ".lock":
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(x[1] for x in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        with _file_lock(_get_lock_path(path), blocking=False) as locked:
+            if not locked:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
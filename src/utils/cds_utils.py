@@ -1,9 +1,35 @@
+import json
 import os
+import time
 from pathlib import Path
 from typing import Literal
 
 import cdsapi
-import ocha_stratus as stratus
+
+from src.utils import blob
+
+
+def download_raw_cds_api(dataset: str, request: dict, local_filepath):
+    local_filepath = Path(local_filepath)
+    if not local_filepath.parent.exists():
+        os.makedirs(local_filepath.parent)
+    c = cdsapi.Client()
+    response = c.retrieve(dataset, request)
+    response.download(local_filepath)
+    return local_filepath
+
+
+def upload_local_file_to_blob(
+    local_filepath,
+    blob_name: str,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    keep_local_copy: bool = True,
+):
+    with open(local_filepath, "rb") as file:
+        blob.upload_blob_data(blob_name, file, prod_dev=prod_dev)
+    if not keep_local_copy:
+        os.remove(local_filepath)
+    return local_filepath if keep_local_copy else None
 
 
 def download_raw_cds_api_to_blob(
@@ -14,13 +40,181 @@ def download_raw_cds_api_to_blob(
     keep_local_copy: bool = True,
 ):
     local_filepath = "temp" / Path(blob_name)
+    download_raw_cds_api(dataset, request, local_filepath)
+    return upload_local_file_to_blob(
+        local_filepath,
+        blob_name,
+        prod_dev=prod_dev,
+        keep_local_copy=keep_local_copy,
+    )
+
+
+CDS_MANIFEST_PATH = Path("temp") / "cds_manifest.json"
+
+
+def _load_manifest(manifest_path) -> dict:
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest: dict, manifest_path):
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _get_cds_client():
+    # cdsapi wraps an ecmwf-datastores client, set up from the same
+    # credentials, whose requests can be polled and resumed by request ID
+    return cdsapi.Client(delete=False).client
+
+
+def _is_downloaded(
+    target: str, to_blob: bool, prod_dev: Literal["prod", "dev"]
+) -> bool:
+    if to_blob:
+        metadata = blob.blob_metadata(target, prod_dev=prod_dev)
+        return metadata.get(target, {}).get("size", 0) > 0
+    path = Path(target)
+    return path.exists() and path.stat().st_size > 0
+
+
+def download_cds_requests(
+    jobs: dict,
+    manifest_path=CDS_MANIFEST_PATH,
+    max_in_flight: int = 4,
+    poll_interval: float = 30,
+    to_blob: bool = True,
+    prod_dev: Literal["prod", "dev"] = "dev",
+    keep_local_copy: bool = True,
+    client=None,
+) -> dict:
+    """Submit many CDS requests concurrently and download the results.
+
+    Up to `max_in_flight` requests are queued on the CDS at once, and their
+    status is polled every `poll_interval` seconds. The state of each
+    request (queued, running, done or failed) and its CDS request ID are
+    recorded in a JSON manifest after every change, so that rerunning after
+    an interruption picks up requests that are already queued instead of
+    resubmitting them. Requests that are done are skipped if their target
+    is still there, and failed requests are retried.
+
+    Parameters
+    ----------
+    jobs : dict
+        Mapping of target to `(dataset, request)`. The target is a blob name
+        if `to_blob` is True, otherwise a local file path.
+    manifest_path : str or Path, optional
+        Path to the JSON manifest, by default `temp/cds_manifest.json`.
+    max_in_flight : int, optional
+        Maximum number of requests submitted at once, by default 4.
+    poll_interval : float, optional
+        Seconds to wait between status checks, by default 30.
+    to_blob : bool, optional
+        Whether to upload results to blob storage (as with
+        `download_raw_cds_api_to_blob`), by default True.
+    prod_dev : Literal["prod", "dev"], optional
+        Stage to upload to, by default "dev".
+    keep_local_copy : bool, optional
+        Whether to keep the local file after uploading, by default True.
+    client : ecmwf.datastores.Client, optional
+        Client to submit requests with, by default the one behind
+        `cdsapi.Client()`. Anything with the same `submit` and
+        `get_remote` methods can be passed.
+
+    Returns
+    -------
+    dict
+        Mapping of target to its final state.
+    """
+    if client is None:
+        client = _get_cds_client()
+    manifest = _load_manifest(manifest_path)
+    pending, active = [], {}
+    for target in jobs:
+        entry = manifest.get(target)
+        if entry is not None and entry["state"] == "done":
+            if _is_downloaded(target, to_blob, prod_dev):
+                continue
+            print(f"{target} is done but missing, resubmitting")
+            del manifest[target]
+        elif entry is not None and entry["state"] in ("queued", "running"):
+            try:
+                active[target] = client.get_remote(entry["request_id"])
+                continue
+            except Exception as e:
+                print(f"Could not resume {target}, resubmitting: {e}")
+        pending.append(target)
+
+    while pending or active:
+        while pending and len(active) < max_in_flight:
+            target = pending.pop(0)
+            dataset, request = jobs[target]
+            try:
+                job = client.submit(dataset, request)
+                manifest[target] = {
+                    "state": "queued",
+                    "request_id": job.request_id,
+                }
+                active[target] = job
+            except Exception as e:
+                print(f"Failed to submit {target}")
+                print(e)
+                manifest[target] = {"state": "failed", "error": str(e)}
+            _save_manifest(manifest, manifest_path)
+
+        for target, job in list(active.items()):
+            entry = manifest[target]
+            try:
+                status = job.status
+                if status == "successful":
+                    _download_cds_job(
+                        job, target, to_blob, prod_dev, keep_local_copy
+                    )
+                    entry["state"] = "done"
+                elif status in ("failed", "rejected", "dismissed", "deleted"):
+                    entry["state"] = "failed"
+                    entry["error"] = f"CDS request {status}"
+                else:
+                    entry["state"] = (
+                        "running" if status == "running" else "queued"
+                    )
+            except Exception as e:
+                print(f"Failed to download {target}")
+                print(e)
+                entry["state"] = "failed"
+                entry["error"] = str(e)
+            if entry["state"] in ("done", "failed"):
+                del active[target]
+            _save_manifest(manifest, manifest_path)
+
+        if active:
+            time.sleep(poll_interval)
+
+    return {target: manifest[target]["state"] for target in jobs}
+
+
+def _download_cds_job(
+    job,
+    target: str,
+    to_blob: bool,
+    prod_dev: Literal["prod", "dev"],
+    keep_local_copy: bool,
+):
+    local_filepath = "temp" / Path(target) if to_blob else Path(target)
     if not local_filepath.parent.exists():
         os.makedirs(local_filepath.parent)
-    c = cdsapi.Client()
-    response = c.retrieve(dataset, request)
-    response.download(local_filepath)
-    with open(local_filepath, "rb") as file:
-        stratus.upload_blob_data(file, blob_name, stage=prod_dev)
-    if not keep_local_copy:
-        os.remove(local_filepath)
-    return local_filepath if keep_local_copy else None
+    job.download(str(local_filepath))
+    if to_blob:
+        upload_local_file_to_blob(
+            local_filepath,
+            target,
+            prod_dev=prod_dev,
+            keep_local_copy=keep_local_copy,
+        )
@@ -0,0 +1,180 @@
+import datetime
+import os
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+BLOB_LOCAL_DIR = Path(os.getenv("AA_BLOB_LOCAL_DIR", "temp/local_blob"))
+# Added to each request, as seconds of latency and bytes per second
+BLOB_LATENCY = float(os.getenv("AA_BLOB_LATENCY", 0))
+BLOB_BANDWIDTH = float(os.getenv("AA_BLOB_BANDWIDTH", 0))
+# Size of the ranges a download with max_concurrency > 1 is split into, as
+# the Azure SDK does by default
+DOWNLOAD_CHUNK_SIZE = 4 * 1024**2
+
+
+class LocalContainerClient:
+    """Stand-in for an Azure container whose blobs are the files under
+    `root`.
+
+    Implements the parts of `azure.storage.blob.ContainerClient` that
+    `src.utils.blob` uses. Set `AA_BLOB_BACKEND=local` to have
+    `blob.get_container_client` return one, so that loaders, caching and
+    pushdown can be run and benchmarked without a network. Latency and
+    bandwidth limits are added to every request to mimic a remote
+    container reproducibly.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory holding the blobs, created if needed. Blob names map to
+        paths relative to it.
+    latency : float, optional
+        Seconds added to each request, by default `AA_BLOB_LATENCY`.
+    bandwidth : float, optional
+        Bytes per second each request is limited to, by default
+        `AA_BLOB_BANDWIDTH`. 0 means unlimited.
+    """
+
+    def __init__(self, root, latency: float = None, bandwidth: float = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.latency = BLOB_LATENCY if latency is None else latency
+        self.bandwidth = BLOB_BANDWIDTH if bandwidth is None else bandwidth
+        self.url = self.root.resolve().as_uri()
+
+    def _throttle(self, n_bytes: int = 0):
+        delay = self.latency
+        if self.bandwidth:
+            delay += n_bytes / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def get_blob_client(self, blob):
+        return LocalBlobClient(self, blob)
+
+    def list_blobs(self, name_starts_with=None):
+        """List blobs in name order, in one request as far as throttling
+        is concerned."""
+        self._throttle()
+        prefix = name_starts_with or ""
+        # Only walk the deepest folder that can hold matching blobs
+        folder = self.root / prefix.rpartition("/")[0]
+        if not folder.is_dir():
+            return []
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [x for x in dirnames if not x.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                path = Path(dirpath) / filename
+                name = path.relative_to(self.root).as_posix()
+                if name.startswith(prefix):
+                    blobs.append(_get_properties(name, path))
+        return sorted(blobs, key=lambda x: x.name)
+
+    def upload_blob(self, name, data, overwrite=False, **kwargs):
+        return self.get_blob_client(name).upload_blob(
+            data, overwrite=overwrite
+        )
+
+    def delete_blob(self, blob, **kwargs):
+        self.get_blob_client(blob).delete_blob()
+
+
+class LocalBlobClient:
+    def __init__(self, container: LocalContainerClient, blob_name: str):
+        self.container = container
+        self.blob_name = blob_name
+        self.path = container.root / blob_name
+
+    def exists(self) -> bool:
+        self.container._throttle()
+        return self.path.is_file()
+
+    def get_blob_properties(self):
+        self.container._throttle()
+        if not self.path.is_file():
+            raise ResourceNotFoundError(f"{self.blob_name} not found")
+        return _get_properties(self.blob_name, self.path)
+
+    def download_blob(self, offset=None, length=None, max_concurrency=1):
+        if not self.path.is_file():
+            self.container._throttle()
+            raise ResourceNotFoundError(f"{self.blob_name} not found")
+        size = self.path.stat().st_size
+        start = offset or 0
+        end = size if length is None else min(start + length, size)
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        # Like the SDK, a parallel download fetches ranges concurrently, so
+        # the delay is that of the ranges spread over the workers
+        chunks = [
+            min(DOWNLOAD_CHUNK_SIZE, len(data) - x)
+            for x in range(0, max(len(data), 1), DOWNLOAD_CHUNK_SIZE)
+        ]
+        if max_concurrency > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_concurrency) as executor:
+                list(executor.map(self.container._throttle, chunks))
+        else:
+            for n_bytes in chunks:
+                self.container._throttle(n_bytes)
+        return LocalDownloader(data)
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            data = data.read()
+        self.container._throttle(len(data))
+        if not overwrite and self.path.exists():
+            raise ResourceExistsError(f"{self.blob_name} already exists")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so readers never see a partial blob
+        tmp_path = self.path.with_name(f".{self.path.name}.{uuid.uuid4()}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+        properties = _get_properties(self.blob_name, self.path)
+        return {
+            "etag": properties.etag,
+            "last_modified": properties.last_modified,
+        }
+
+    def delete_blob(self, **kwargs):
+        self.container._throttle()
+        if not self.path.is_file():
+            raise ResourceNotFoundError(f"{self.blob_name} not found")
+        self.path.unlink()
+
+
+class LocalDownloader:
+    """Downloaded blob content, read like a `StorageStreamDownloader`."""
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self.size = len(data)
+
+    def readall(self) -> bytes:
+        return self._data
+
+    def readinto(self, stream) -> int:
+        stream.write(self._data)
+        return self.size
+
+
+def _get_properties(blob_name: str, path: Path):
+    stat = path.stat()
+    return types.SimpleNamespace(
+        name=blob_name,
+        size=stat.st_size,
+        etag=f'"0x{stat.st_mtime_ns:X}{stat.st_size:X}"',
+        last_modified=datetime.datetime.fromtimestamp(
+            stat.st_mtime, tz=datetime.timezone.utc
+        ),
+    )
@@ -1,5 +1,22 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import netCDF4
 import numpy as np
+import pandas as pd
+import rioxarray  # noqa: F401
+import shapely
 import xarray as xr
+from rasterio import features, warp
+from scipy import sparse
+
+ZONES_CACHE_DIR = Path(os.getenv("AA_ZONES_CACHE_DIR", "temp/zones"))
+REGRID_CACHE_DIR = Path(os.getenv("AA_REGRID_CACHE_DIR", "temp/regrid"))
+ZONAL_STATS = ("sum", "mean", "count", "min", "max")
+# Encoding of the source variable kept when writing it compressed
+KEPT_ENCODING = ("dtype", "scale_factor", "add_offset", "_FillValue")
 
 
 def compute_density_from_grid(da, lat_name="lat", lon_name="lon"):
@@ -43,3 +60,848 @@ def compute_pop_from_density(da_density, lat_name="lat", lon_name="lon"):
     da_pop.name = "population_per_pixel"
     da_pop.attrs["units"] = "people per pixel"
     return da_pop
+
+
+def _get_grid(da, x_dim: str, y_dim: str):
+    da = da.rio.set_spatial_dims(x_dim=x_dim, y_dim=y_dim)
+    return da.rio.transform(recalc=True), (da[y_dim].size, da[x_dim].size)
+
+
+def _get_zones_key(zones, transform, shape, all_touched) -> str:
+    h = hashlib.sha256()
+    h.update(repr((tuple(transform)[:6], shape, all_touched)).encode())
+    for name, geometries in zones.items():
+        h.update(repr(name).encode())
+        for geometry in geometries:
+            h.update(geometry.wkb)
+    return h.hexdigest()
+
+
+def _encode_names(names):
+    """Zone names as strings and the dtype to restore them to, so they can
+    be cached without pickling, or None if they wouldn't come back the
+    same."""
+    strings = np.array([str(x) for x in names])
+    dtype = np.array(str(pd.Index(names).dtype))
+    try:
+        decoded = _decode_names(strings, dtype)
+    except (TypeError, ValueError):
+        return None
+    if decoded != list(names) or [type(x) for x in decoded] != [
+        type(x) for x in names
+    ]:
+        return None
+    return strings, dtype
+
+
+def _decode_names(strings, dtype) -> list:
+    dtype = str(dtype)
+    if dtype in ("object", "str", "string"):
+        return strings.tolist()
+    if dtype == "bool":
+        return (strings == "True").tolist()
+    return pd.Index(strings).astype(dtype).tolist()
+
+
+def _get_window(geometries, transform, shape):
+    """Get the (row_start, row_stop, col_start, col_stop) of the pixels
+    around some geometries, or None if they are off the grid."""
+    minx, miny, maxx, maxy = np.array([x.bounds for x in geometries]).T
+    cols, rows = ~transform * (
+        np.array([minx.min(), maxx.max(), minx.min(), maxx.max()]),
+        np.array([miny.min(), miny.min(), maxy.max(), maxy.max()]),
+    )
+    row_start = max(int(np.floor(rows.min())) - 1, 0)
+    row_stop = min(int(np.ceil(rows.max())) + 1, shape[0])
+    col_start = max(int(np.floor(cols.min())) - 1, 0)
+    col_stop = min(int(np.ceil(cols.max())) + 1, shape[1])
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return row_start, row_stop, col_start, col_stop
+
+
+def _get_window_mask(geometries, transform, window, all_touched):
+    row_start, row_stop, col_start, col_stop = window
+    return features.geometry_mask(
+        geometries,
+        out_shape=(row_stop - row_start, col_stop - col_start),
+        transform=transform * transform.translation(col_start, row_start),
+        all_touched=all_touched,
+        invert=True,
+    )
+
+
+def _rasterize_zone(geometries, transform, shape, all_touched):
+    """Get the flat indices of the pixels in a zone, as `rio.clip` would
+    select them, rasterizing only the window around the zone."""
+    window = _get_window(geometries, transform, shape)
+    if window is None:
+        return np.array([], dtype=np.int64)
+    mask = _get_window_mask(geometries, transform, window, all_touched)
+    rows, cols = np.nonzero(mask)
+    return (rows + window[0]) * shape[1] + cols + window[2]
+
+
+def _get_zone_coverage(geometries, transform, shape):
+    """Get the flat indices of the pixels a zone overlaps and the fraction
+    of each pixel's area it covers.
+
+    Pixels touched by the zone but not by its boundary are wholly inside
+    it, so only those on the boundary are intersected exactly.
+    """
+    window = _get_window(geometries, transform, shape)
+    if window is None:
+        return np.array([], dtype=np.int64), np.array([])
+    zone = shapely.union_all(geometries)
+    touched = _get_window_mask([zone], transform, window, True)
+    edge = _get_window_mask([zone.boundary], transform, window, True)
+    rows, cols = np.nonzero(touched | edge)
+    fractions = np.ones(rows.size)
+    on_edge = edge[rows, cols]
+    if on_edge.any():
+        row_edge = rows[on_edge] + window[0]
+        col_edge = cols[on_edge] + window[2]
+        x0, y0 = transform * (col_edge, row_edge)
+        x1, y1 = transform * (col_edge + 1, row_edge + 1)
+        pixels = shapely.box(
+            np.minimum(x0, x1),
+            np.minimum(y0, y1),
+            np.maximum(x0, x1),
+            np.maximum(y0, y1),
+        )
+        fractions[on_edge] = shapely.area(
+            shapely.intersection(pixels, zone)
+        ) / abs(transform.a * transform.e - transform.b * transform.d)
+    keep = fractions > 0
+    flat = (rows[keep] + window[0]) * shape[1] + cols[keep] + window[2]
+    return flat, np.minimum(fractions[keep], 1)
+
+
+def rasterize_zones(
+    gdf,
+    zone_col: str,
+    da,
+    x_dim: str = "x",
+    y_dim: str = "y",
+    all_touched: bool = False,
+    cache_dir: Path = ZONES_CACHE_DIR,
+):
+    """Rasterize zones onto the grid of a raster, once.
+
+    Each zone is the union of the geometries sharing a value of
+    `zone_col`. A pixel is in a zone if `rio.clip` with the same
+    `all_touched` would keep it, so pixels on a shared border can be in
+    more than one zone. The result is saved under `cache_dir`, keyed by a
+    hash of the grid and the geometries, and reused on later calls.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Zone geometries, in the CRS of `da` if it has one.
+    zone_col : str
+        Column identifying each zone, e.g. "ADM2_PCODE".
+    da : xr.DataArray or xr.Dataset
+        Raster defining the grid.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions, by default "x" and "y".
+    all_touched : bool, optional
+        Include all pixels touched by a geometry rather than those whose
+        centre is inside it, by default False.
+    cache_dir : Path, optional
+        Folder to cache results in, or None to not cache.
+
+    Returns
+    -------
+    tuple
+        Zone names in order of first appearance in `gdf`, flat pixel
+        indices into the (y, x) grid, and the position in the zone names of
+        the zone each pixel index belongs to, with pixels grouped by zone.
+    """
+    if da.rio.crs is not None and gdf.crs is not None:
+        gdf = gdf.to_crs(da.rio.crs)
+    transform, shape = _get_grid(da, x_dim, y_dim)
+    zones = {
+        name: list(group.geometry)
+        for name, group in gdf.groupby(zone_col, sort=False)
+    }
+    cache_path = None
+    if cache_dir is not None:
+        key = _get_zones_key(zones, transform, shape, all_touched)
+        cache_path = Path(cache_dir) / f"{key}.npz"
+        try:
+            with np.load(cache_path, allow_pickle=False) as cached:
+                return (
+                    _decode_names(cached["names"], cached["names_dtype"]),
+                    cached["pixels"],
+                    cached["zones"],
+                )
+        except (OSError, KeyError, ValueError):
+            # Not cached, or cached in an older format
+            pass
+    pixels = [
+        _rasterize_zone(geometries, transform, shape, all_touched)
+        for geometries in zones.values()
+    ]
+    names = list(zones)
+    zone_idx = np.repeat(np.arange(len(names)), [len(x) for x in pixels])
+    pixels = np.concatenate(pixels) if pixels else np.array([], np.int64)
+    # Zone names that can't be stored without pickling aren't cached
+    encoded_names = _encode_names(names) if cache_path is not None else None
+    if encoded_names is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.npz")
+        np.savez(
+            tmp_path,
+            names=encoded_names[0],
+            names_dtype=encoded_names[1],
+            pixels=pixels,
+            zones=zone_idx,
+        )
+        os.replace(tmp_path, cache_path)
+    return names, pixels, zone_idx
+
+
+def compute_zonal_stats(
+    da,
+    gdf,
+    zone_col: str,
+    stats=("mean",),
+    x_dim: str = "x",
+    y_dim: str = "y",
+    all_touched: bool = False,
+    chunk_size: int = 366,
+    cache_dir: Path = ZONES_CACHE_DIR,
+) -> pd.DataFrame:
+    """Compute statistics of a raster over zones, for all zones and time
+    steps at once.
+
+    Replaces looping over zones and calling `rio.clip` on the whole cube
+    for each one: the zones are rasterized once (see `rasterize_zones`),
+    then each statistic is found for every zone and step with a single
+    `reduceat` over the pixels grouped by zone. NaN pixels are ignored, as
+    with `rio.clip(...).mean(...)`.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Raster with dimensions `y_dim` and `x_dim`, and any others (e.g.
+        time).
+    gdf : gpd.GeoDataFrame
+        Zone geometries.
+    zone_col : str
+        Column identifying each zone, e.g. "ADM2_PCODE".
+    stats : sequence of str, optional
+        Statistics to compute, from "sum", "mean", "count", "min" and
+        "max", by default only "mean". "sum" is 0 and the others NaN for a
+        zone with no valid pixels.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions, by default "x" and "y".
+    all_touched : bool, optional
+        Passed to `rasterize_zones`, by default False.
+    chunk_size : int, optional
+        Number of steps of the leading non-spatial dimension read at a
+        time, to bound memory use, by default 366.
+    cache_dir : Path, optional
+        Passed to `rasterize_zones`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per zone and step, with a column for `zone_col`, one for
+        each other dimension and one for each statistic, ordered by zone
+        and then step.
+    """
+    unknown = set(stats) - set(ZONAL_STATS)
+    if unknown:
+        raise ValueError(f"Invalid stats: {sorted(unknown)}")
+    names, pixels, zone_idx = rasterize_zones(
+        gdf,
+        zone_col,
+        da,
+        x_dim=x_dim,
+        y_dim=y_dim,
+        all_touched=all_touched,
+        cache_dir=cache_dir,
+    )
+    other_dims = [x for x in da.dims if x not in (x_dim, y_dim)]
+    da = da.transpose(*other_dims, y_dim, x_dim)
+    n_steps = int(np.prod([da[x].size for x in other_dims]))
+    n_zones = len(names)
+    # reduceat needs non-empty groups, so only reduce zones with pixels
+    has_pixels = np.bincount(zone_idx, minlength=n_zones) > 0
+    idx = np.searchsorted(zone_idx, np.arange(n_zones))[has_pixels]
+
+    results = {
+        x: np.full(
+            (n_steps, n_zones), 0.0 if x in ("sum", "count") else np.nan
+        )
+        for x in stats
+    }
+    blocks = _iter_blocks(da, other_dims, chunk_size) if idx.size else []
+    for start, stop, values in blocks:
+        values = values[:, pixels]
+        valid = ~np.isnan(values)
+        count = np.add.reduceat(valid, idx, axis=1)
+        chunk = {"count": count}
+        if {"sum", "mean"} & set(stats):
+            chunk["sum"] = np.add.reduceat(
+                np.where(valid, values, 0), idx, axis=1
+            )
+            with np.errstate(invalid="ignore", divide="ignore"):
+                chunk["mean"] = np.where(
+                    count > 0, chunk["sum"] / count, np.nan
+                )
+        with np.errstate(invalid="ignore"):
+            if "min" in stats:
+                chunk["min"] = np.fmin.reduceat(values, idx, axis=1)
+            if "max" in stats:
+                chunk["max"] = np.fmax.reduceat(values, idx, axis=1)
+        for stat in stats:
+            results[stat][start:stop, has_pixels] = chunk[stat]
+
+    df = _get_zonal_frame(results, names, da, other_dims, zone_col)
+    if "count" in stats:
+        df["count"] = df["count"].astype(int)
+    return df
+
+
+def _iter_blocks(da, other_dims, chunk_size):
+    """Read a raster with dimensions (*other_dims, y, x) a block of the
+    leading dimension at a time, yielding the (start, stop) rows of each
+    block in the flattened non-spatial steps and its values as a (steps,
+    pixels) array."""
+    n_lead = da[other_dims[0]].size if other_dims else 1
+    step = int(np.prod([da[x].size for x in other_dims[1:]]))
+    for start in range(0, n_lead, chunk_size):
+        stop = min(start + chunk_size, n_lead)
+        block = da
+        if other_dims:
+            block = da.isel({other_dims[0]: slice(start, stop)})
+        values = np.asarray(block.values, dtype=float).reshape(
+            (stop - start) * step, -1
+        )
+        yield start * step, stop * step, values
+
+
+def _get_zonal_frame(results, names, da, other_dims, zone_col):
+    index = pd.MultiIndex.from_product(
+        [names] + [da[x].values for x in other_dims],
+        names=[zone_col] + other_dims,
+    )
+    return pd.DataFrame(
+        {x: y.T.reshape(-1) for x, y in results.items()}, index=index
+    ).reset_index()
+
+
+def coverage_weights(
+    gdf,
+    zone_col: str,
+    da,
+    x_dim: str = "x",
+    y_dim: str = "y",
+    cache_dir: Path = ZONES_CACHE_DIR,
+):
+    """Get the fraction of each pixel of a raster covered by each zone.
+
+    Unlike `rasterize_zones`, which counts a pixel wholly in every zone
+    that touches it (`all_touched=True`) or only in the zone holding its
+    centre, each pixel is split between zones by the area of it they
+    cover, so zonal sums neither double count nor miss pixels on borders
+    and small zones are not over- or under-weighted. Areas are in the
+    units of the grid. The result is saved under `cache_dir`, keyed by a
+    hash of the grid and the geometries, and reused on later calls.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Zone geometries, in the CRS of `da` if it has one.
+    zone_col : str
+        Column identifying each zone, e.g. "ADM2_PCODE".
+    da : xr.DataArray or xr.Dataset
+        Raster defining the grid.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions, by default "x" and "y".
+    cache_dir : Path, optional
+        Folder to cache results in, or None to not cache.
+
+    Returns
+    -------
+    tuple
+        Zone names in order of first appearance in `gdf`, and a sparse
+        (zones, pixels) matrix of coverage fractions, with pixels
+        flattened from the (y, x) grid.
+    """
+    if da.rio.crs is not None and gdf.crs is not None:
+        gdf = gdf.to_crs(da.rio.crs)
+    transform, shape = _get_grid(da, x_dim, y_dim)
+    zones = {
+        name: list(group.geometry)
+        for name, group in gdf.groupby(zone_col, sort=False)
+    }
+    cache_path = None
+    if cache_dir is not None:
+        key = _get_zones_key(zones, transform, shape, "coverage")
+        cache_path = Path(cache_dir) / f"{key}.npz"
+        try:
+            weights, cached = _load_sparse(cache_path)
+            return (
+                _decode_names(cached["names"], cached["names_dtype"]),
+                weights,
+            )
+        except (OSError, KeyError, ValueError):
+            # Not cached, or cached in an older format
+            pass
+    names = list(zones)
+    coverage = [
+        _get_zone_coverage(geometries, transform, shape)
+        for geometries in zones.values()
+    ]
+    weights = sparse.csr_matrix(
+        (
+            np.concatenate([x[1] for x in coverage] + [np.array([])]),
+            np.concatenate(
+                [x[0] for x in coverage] + [np.array([], np.int64)]
+            ),
+            np.cumsum([0] + [len(x[0]) for x in coverage]),
+        ),
+        shape=(len(names), shape[0] * shape[1]),
+    )
+    weights.sort_indices()
+    # Zone names that can't be stored without pickling aren't cached
+    encoded_names = _encode_names(names) if cache_path is not None else None
+    if encoded_names is not None:
+        _save_sparse(
+            cache_path,
+            weights,
+            names=encoded_names[0],
+            names_dtype=encoded_names[1],
+        )
+    return names, weights
+
+
+def _save_sparse(path: Path, matrix, **arrays):
+    """Save a sparse CSR matrix, and any other arrays, to an .npz file,
+    atomically."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.npz")
+    np.savez(
+        tmp_path,
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        shape=np.array(matrix.shape),
+        **arrays,
+    )
+    os.replace(tmp_path, path)
+
+
+def _load_sparse(path: Path):
+    """Load a sparse CSR matrix saved by `_save_sparse`, and a dict of the
+    other arrays saved with it."""
+    with np.load(path, allow_pickle=False) as cached:
+        matrix = sparse.csr_matrix(
+            (cached["data"], cached["indices"], cached["indptr"]),
+            shape=tuple(cached["shape"]),
+        )
+        arrays = {
+            x: cached[x]
+            for x in cached.files
+            if x not in ("data", "indices", "indptr", "shape")
+        }
+    return matrix, arrays
+
+
+def compute_weighted_zonal_stats(
+    da,
+    gdf,
+    zone_col: str,
+    stats=("mean",),
+    x_dim: str = "x",
+    y_dim: str = "y",
+    chunk_size: int = 366,
+    cache_dir: Path = ZONES_CACHE_DIR,
+) -> pd.DataFrame:
+    """Compute area-weighted statistics of a raster over zones, for all
+    zones and time steps at once.
+
+    Each pixel counts towards a zone by the fraction of it the zone covers
+    (see `coverage_weights`), and the statistics for every zone and step
+    of a block of the raster are a single sparse matrix product. NaN
+    pixels are ignored.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Raster with dimensions `y_dim` and `x_dim`, and any others (e.g.
+        time).
+    gdf : gpd.GeoDataFrame
+        Zone geometries.
+    zone_col : str
+        Column identifying each zone, e.g. "ADM2_PCODE".
+    stats : sequence of str, optional
+        Statistics to compute, by default only "mean". "sum" is the sum of
+        pixel values times their coverage, "count" the number of valid
+        pixels covered (fractional) and "mean" their ratio. "sum" and
+        "count" are 0 and "mean" NaN for a zone with no valid pixels.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions, by default "x" and "y".
+    chunk_size : int, optional
+        Number of steps of the leading non-spatial dimension read at a
+        time, to bound memory use, by default 366.
+    cache_dir : Path, optional
+        Passed to `coverage_weights`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per zone and step, with a column for `zone_col`, one for
+        each other dimension and one for each statistic, ordered by zone
+        and then step.
+    """
+    unknown = set(stats) - {"sum", "mean", "count"}
+    if unknown:
+        raise ValueError(f"Invalid stats: {sorted(unknown)}")
+    names, weights = coverage_weights(
+        gdf, zone_col, da, x_dim=x_dim, y_dim=y_dim, cache_dir=cache_dir
+    )
+    other_dims = [x for x in da.dims if x not in (x_dim, y_dim)]
+    da = da.transpose(*other_dims, y_dim, x_dim)
+    n_steps = int(np.prod([da[x].size for x in other_dims]))
+    # Only read the pixels some zone covers
+    pixels = np.unique(weights.indices)
+    weights = weights[:, pixels]
+
+    results = {x: np.zeros((n_steps, len(names))) for x in stats}
+    for start, stop, values in _iter_blocks(da, other_dims, chunk_size):
+        values = values[:, pixels]
+        valid = ~np.isnan(values)
+        total = (weights @ np.where(valid, values, 0).T).T
+        count = (weights @ valid.T.astype(float)).T
+        chunk = {"sum": total, "count": count}
+        if "mean" in stats:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                chunk["mean"] = np.where(count > 0, total / count, np.nan)
+        for stat in stats:
+            results[stat][start:stop] = chunk[stat]
+
+    return _get_zonal_frame(results, names, da, other_dims, zone_col)
+
+
+def geometry_mask(
+    gdf, da, x_dim: str = "x", y_dim: str = "y", all_touched: bool = False
+) -> xr.DataArray:
+    """Get a boolean mask of the pixels of a raster inside geometries.
+
+    The mask selects the same pixels as `rio.clip` with the same
+    `all_touched`, so it can be computed once and applied to each block of
+    a raster too large to clip at once, with `da.where(mask)`.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        Geometries, in the CRS of `da` if it has one.
+    da : xr.DataArray or xr.Dataset
+        Raster defining the grid.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions, by default "x" and "y".
+    all_touched : bool, optional
+        Include all pixels touched by a geometry rather than those whose
+        centre is inside it, by default False.
+
+    Returns
+    -------
+    xr.DataArray
+        True inside the geometries, with dimensions (`y_dim`, `x_dim`).
+    """
+    if da.rio.crs is not None and gdf.crs is not None:
+        gdf = gdf.to_crs(da.rio.crs)
+    transform, shape = _get_grid(da, x_dim, y_dim)
+    mask = features.geometry_mask(
+        list(gdf.geometry),
+        out_shape=shape,
+        transform=transform,
+        all_touched=all_touched,
+        invert=True,
+    )
+    return xr.DataArray(
+        mask,
+        dims=(y_dim, x_dim),
+        coords={y_dim: da[y_dim], x_dim: da[x_dim]},
+    )
+
+
+def write_netcdf_blocks(
+    blocks,
+    path: Path,
+    dim: str = "time",
+    chunk_size: int = 30,
+    complevel: int = 4,
+    encoding: dict = None,
+    append: bool = False,
+):
+    """Write consecutive blocks of a raster along a dimension to one
+    compressed netCDF, a block at a time.
+
+    Only one block need be in memory at once, so a raster longer than
+    memory allows can be written from a generator of blocks. The file is
+    chunked along `dim` by `chunk_size` and whole along the other
+    dimensions, so reading a run of steps reads few chunks. It is written
+    to a temporary file and moved into place at the end, so readers never
+    see a partial file.
+
+    Parameters
+    ----------
+    blocks : iterable of xr.DataArray or xr.Dataset
+        Consecutive blocks along `dim`, with the same other dimensions,
+        variables and encoding. DataArrays must be named.
+    path : Path
+        File to write.
+    dim : str, optional
+        Dimension the blocks are along, by default "time". It is written as
+        an unlimited dimension.
+    chunk_size : int, optional
+        Number of steps of `dim` per chunk, by default 30.
+    complevel : int, optional
+        zlib compression level, by default 4.
+    encoding : dict, optional
+        Encoding of each variable, by variable name, for when the blocks
+        have lost that of their source (e.g. after `where`). Only the
+        dtype, packing and fill value are used, by default those of the
+        first block.
+    append : bool, optional
+        If True and `path` exists, write the blocks into a copy of it
+        instead of starting afresh: from the first block's first step if
+        that step is already in the file, overwriting it and those after
+        it, otherwise after its last step. By default False.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    stored = None
+    if append and path.exists():
+        with xr.open_dataset(path) as existing:
+            stored = existing[dim].values
+        # Append to a copy, so a failed append leaves the file as it was
+        shutil.copyfile(path, tmp_path)
+    start = None
+    try:
+        for block in blocks:
+            if isinstance(block, xr.DataArray):
+                block = block.to_dataset()
+            if start is None and stored is None:
+                _write_first_block(
+                    block, tmp_path, dim, chunk_size, complevel, encoding
+                )
+                start = 0
+            else:
+                if start is None:
+                    match = np.flatnonzero(stored == block[dim].values[0])
+                    start = match[0] if match.size else stored.size
+                _append_block(block, tmp_path, dim, start)
+            start += block[dim].size
+        if start is None and stored is None:
+            raise ValueError("No blocks to write")
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _write_first_block(ds, path, dim, chunk_size, complevel, var_encoding):
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if dim not in var.dims:
+            continue
+        source = (var_encoding or {}).get(name, var.encoding)
+        encoding[name] = {
+            key: value for key, value in source.items() if key in KEPT_ENCODING
+        }
+        encoding[name].update(
+            zlib=True,
+            complevel=complevel,
+            chunksizes=tuple(
+                chunk_size if x == dim else ds[x].size for x in var.dims
+            ),
+        )
+    ds.to_netcdf(path, unlimited_dims=[dim], encoding=encoding)
+
+
+def _append_block(ds, path, dim, start):
+    with netCDF4.Dataset(path, "a") as nc:
+        for name, var in ds.variables.items():
+            if dim not in var.dims:
+                continue
+            values = var.values
+            if np.issubdtype(values.dtype, np.datetime64):
+                values = netCDF4.date2num(
+                    pd.to_datetime(values.ravel()).to_pydatetime(),
+                    nc[name].units,
+                    getattr(nc[name], "calendar", "standard"),
+                ).reshape(values.shape)
+            elif np.issubdtype(values.dtype, np.floating):
+                # netCDF4 only writes the fill value for masked values
+                values = np.ma.masked_array(
+                    np.nan_to_num(values), mask=np.isnan(values)
+                )
+            index = tuple(
+                slice(start, start + ds[dim].size) if x == dim else slice(None)
+                for x in var.dims
+            )
+            nc[name][index] = values
+
+
+def _get_regrid_key(src_grid, dst_grid) -> str:
+    h = hashlib.sha256()
+    for transform, shape, crs in (src_grid, dst_grid):
+        h.update(repr((tuple(transform)[:6], shape)).encode())
+        h.update(str(crs.to_wkt() if crs is not None else None).encode())
+    return h.hexdigest()
+
+
+def regrid_weights(
+    src,
+    dst,
+    x_dim: str = "x",
+    y_dim: str = "y",
+    dst_x_dim: str = "x",
+    dst_y_dim: str = "y",
+    cache_dir: Path = REGRID_CACHE_DIR,
+):
+    """Get the mapping from the pixels of one grid to those of another, as
+    a sparse matrix.
+
+    Each target pixel takes the value of the source pixel holding its
+    centre (nearest neighbour), as `rio.reproject_match` does by default,
+    so regridding any raster on the source grid is a single sparse matrix
+    product (see `regrid`). The result is saved under `cache_dir`, keyed by
+    a hash of the two grids, and reused on later calls.
+
+    Parameters
+    ----------
+    src : xr.DataArray or xr.Dataset
+        Raster defining the source grid.
+    dst : xr.DataArray or xr.Dataset
+        Raster defining the target grid.
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions of `src`, by default "x" and "y".
+    dst_x_dim, dst_y_dim : str, optional
+        Names of the spatial dimensions of `dst`, by default "x" and "y".
+    cache_dir : Path, optional
+        Folder to cache results in, or None to not cache.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (target pixels, source pixels) matrix of 0s and 1s, with pixels
+        flattened from the (y, x) grids. Rows of target pixels outside the
+        source grid are empty.
+    """
+    src_transform, src_shape = _get_grid(src, x_dim, y_dim)
+    dst_transform, dst_shape = _get_grid(dst, dst_x_dim, dst_y_dim)
+    src_crs, dst_crs = src.rio.crs, dst.rio.crs
+    cache_path = None
+    if cache_dir is not None:
+        key = _get_regrid_key(
+            (src_transform, src_shape, src_crs),
+            (dst_transform, dst_shape, dst_crs),
+        )
+        cache_path = Path(cache_dir) / f"{key}.npz"
+        if cache_path.exists():
+            return _load_sparse(cache_path)[0]
+    rows, cols = np.indices(dst_shape).reshape(2, -1)
+    xs, ys = dst_transform * (cols + 0.5, rows + 0.5)
+    if src_crs is not None and dst_crs is not None and src_crs != dst_crs:
+        xs, ys = map(np.asarray, warp.transform(dst_crs, src_crs, xs, ys))
+    src_cols, src_rows = ~src_transform * (xs, ys)
+    src_cols = np.floor(src_cols).astype(np.int64)
+    src_rows = np.floor(src_rows).astype(np.int64)
+    inside = (
+        (src_cols >= 0)
+        & (src_cols < src_shape[1])
+        & (src_rows >= 0)
+        & (src_rows < src_shape[0])
+    )
+    weights = sparse.csr_matrix(
+        (
+            np.ones(inside.sum(), dtype=np.float32),
+            (
+                np.flatnonzero(inside),
+                src_rows[inside] * src_shape[1] + src_cols[inside],
+            ),
+        ),
+        shape=(dst_shape[0] * dst_shape[1], src_shape[0] * src_shape[1]),
+    )
+    if cache_path is not None:
+        _save_sparse(cache_path, weights)
+    return weights
+
+
+def regrid(
+    da,
+    dst,
+    weights=None,
+    x_dim: str = "x",
+    y_dim: str = "y",
+    dst_x_dim: str = "x",
+    dst_y_dim: str = "y",
+    cache_dir: Path = REGRID_CACHE_DIR,
+) -> xr.DataArray:
+    """Regrid a raster onto the grid of another, by nearest neighbour.
+
+    Gives the same result as `da.rio.reproject_match(dst)`, but with the
+    mapping between the grids found once (see `regrid_weights`) and
+    applied as a sparse matrix product, in the dtype of `da` if it is a
+    float.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Raster to regrid, with dimensions `y_dim` and `x_dim`, and any
+        others (e.g. time).
+    dst : xr.DataArray or xr.Dataset
+        Raster defining the target grid.
+    weights : scipy.sparse.csr_matrix, optional
+        Output of `regrid_weights` for the grids of `da` and `dst`, by
+        default found (or loaded from `cache_dir`).
+    x_dim, y_dim : str, optional
+        Names of the spatial dimensions of `da`, by default "x" and "y".
+    dst_x_dim, dst_y_dim : str, optional
+        Names of the spatial dimensions of `dst`, by default "x" and "y".
+    cache_dir : Path, optional
+        Passed to `regrid_weights`.
+
+    Returns
+    -------
+    xr.DataArray
+        `da` on the grid of `dst`, NaN outside the grid of `da`, with the
+        CRS of `dst`.
+    """
+    if weights is None:
+        weights = regrid_weights(
+            da,
+            dst,
+            x_dim=x_dim,
+            y_dim=y_dim,
+            dst_x_dim=dst_x_dim,
+            dst_y_dim=dst_y_dim,
+            cache_dir=cache_dir,
+        )
+    other_dims = [x for x in da.dims if x not in (x_dim, y_dim)]
+    da = da.transpose(*other_dims, y_dim, x_dim)
+    values = da.values.reshape(-1, da[y_dim].size * da[x_dim].size)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    out = (weights.astype(values.dtype) @ values.T).T
+    out[:, np.diff(weights.indptr) == 0] = np.nan
+    shape = [da[x].size for x in other_dims]
+    shape += [dst[dst_y_dim].size, dst[dst_x_dim].size]
+    regridded = xr.DataArray(
+        out.reshape(shape),
+        dims=other_dims + [dst_y_dim, dst_x_dim],
+        coords={
+            **{x: da[x] for x in other_dims},
+            dst_y_dim: dst[dst_y_dim],
+            dst_x_dim: dst[dst_x_dim],
+        },
+        name=da.name,
+        attrs=da.attrs,
+    )
+    return regridded.rio.write_crs(dst.rio.crs)
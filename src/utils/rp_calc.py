@@ -1,8 +1,8 @@
-from typing import List, Optional, Union
+from typing import List, Literal, Optional, Union
 
 import numpy as np
 import pandas as pd
-from scipy import stats
+from scipy import special, stats
 
 
 def calculate_groups_rp(
@@ -10,29 +10,40 @@ def calculate_groups_rp(
 ):
     """Calculate the empirical RP for each group in a DataFrame.
 
+    Gives the same result as applying `calculate_one_group_rp` to each
+    group, but ranks all groups at once instead of one at a time.
+
     Parameters
     ----------
     df : pd.DataFrame
         The DataFrame for which to calculate the RP.
     by : List
         The columns by which to group the DataFrame.
+    col_name : str, optional
+        The name of the column for which to calculate the RP, by default
+        "mean".
+    ascending : bool, optional
+        Whether to rank the column in ascending order, by default True. See
+        `calculate_one_group_rp`.
 
     Returns
     -------
     pd.DataFrame
-        The input DataFrame with the RP columns added.
+        The input DataFrame with the RP columns added, sorted by `by` and
+        with the `by` columns first.
     """
-    return (
-        df.groupby(by)
-        .apply(
-            calculate_one_group_rp,
-            col_name=col_name,
-            ascending=ascending,
-            include_groups=False,
-        )
-        .reset_index()
-        .drop(columns=f"level_{len(by)}")
-    )
+    grouped = df.groupby(by, observed=True)
+    # Rows with a missing group key are in no group, as with groupby
+    group = grouped.ngroup()
+    in_group = group.notna().to_numpy()
+    rank = grouped[col_name].rank(ascending=ascending).to_numpy()[in_group]
+    size = grouped[col_name].transform("size").to_numpy()[in_group]
+    df = df[in_group].assign(**{f"{col_name}_rank": rank.astype(int)})
+    df[f"{col_name}_rp"] = (size + 1) / df[f"{col_name}_rank"]
+    # Put groups in the order groupby would, keeping row order within them
+    order = np.argsort(group[in_group].to_numpy(), kind="stable")
+    df = df.take(order).reset_index(drop=True)
+    return df[list(by) + [x for x in df.columns if x not in by]]
 
 
 def calculate_one_group_rp(group, col_name: str = "q", ascending: bool = True):
@@ -62,36 +73,6 @@ def calculate_one_group_rp(group, col_name: str = "q", ascending: bool = True):
     return group
 
 
-def calculate_groups_rp(
-    df: pd.DataFrame, by: List, col_name: str = "mean", ascending: bool = True
-):
-    """Calculate the empirical RP for each group in a DataFrame.
-
-    Parameters
-    ----------
-    df : pd.DataFrame
-        The DataFrame for which to calculate the RP.
-    by : List
-        The columns by which to group the DataFrame.
-
-    Returns
-    -------
-    pd.DataFrame
-        The input DataFrame with the RP columns added.
-    """
-    return (
-        df.groupby(by)
-        .apply(
-            calculate_one_group_rp,
-            include_groups=False,
-            col_name=col_name,
-            ascending=ascending,
-        )
-        .reset_index()
-        .drop(columns=f"level_{len(by)}")
-    )
-
-
 def estimate_return_periods(
     df: pd.DataFrame,
     date_col: str,
@@ -186,6 +167,457 @@ def estimate_return_periods_from_values(
     return pd.DataFrame({"value": values, "return_period": return_periods})
 
 
+def get_annual_maxima(
+    df: pd.DataFrame, date_col: str, val_col: str, by: Optional[List] = None
+) -> pd.DataFrame:
+    """Get annual maxima as a (series x years) table for `fit_gumbel_batch`
+    and `fit_gev_batch`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input dataframe containing time series data
+    date_col : str
+        Name of the column containing dates
+    val_col : str
+        Name of the column containing values
+    by : List, optional
+        Columns identifying each series, e.g. ["pcode"]. By default the
+        whole dataframe is one series.
+
+    Returns
+    -------
+    pd.DataFrame
+        Annual maxima with one row per series and one column per year, NaN
+        where a series has no data for a year.
+    """
+    by = list(by) if by is not None else []
+    year = pd.to_datetime(df[date_col]).dt.year.rename("year")
+    keys = [df[x] for x in by] + [year]
+    df_max = df[val_col].groupby(keys, observed=True).max()
+    if not by:
+        return df_max.to_frame().T.reset_index(drop=True)
+    return df_max.unstack("year")
+
+
+def _get_lmoments(annual_max: np.ndarray):
+    """Get the first three sample L-moments of each row, ignoring NaN."""
+    x = np.sort(annual_max, axis=1)  # NaN are sorted to the end
+    valid = ~np.isnan(x)
+    n = valid.sum(axis=1, keepdims=True).astype(float)
+    x = np.where(valid, x, 0)
+    i = np.arange(x.shape[1])[None, :]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        b0 = x.sum(axis=1, keepdims=True) / n
+        b1 = (x * i / (n - 1)).sum(axis=1, keepdims=True) / n
+        b2 = (x * i * (i - 1) / ((n - 1) * (n - 2))).sum(
+            axis=1, keepdims=True
+        ) / n
+    l1 = b0[:, 0]
+    l2 = 2 * b1[:, 0] - b0[:, 0]
+    l3 = 6 * b2[:, 0] - 6 * b1[:, 0] + b0[:, 0]
+    return l1, l2, l3
+
+
+def _refine_gumbel_mle(
+    annual_max: np.ndarray, scale: np.ndarray, max_iter: int, tol: float
+):
+    """Solve the Gumbel likelihood equations for all rows at once, with
+    Newton's method on the scale starting from `scale`."""
+    valid = ~np.isnan(annual_max)
+    n = valid.sum(axis=1)
+    # Centre each row, so that the mean is 0 in the equations below
+    centre = np.nanmean(annual_max, axis=1)
+    x = np.where(valid, annual_max - centre[:, None], 0)
+
+    def get_weights(scale):
+        # exp(-x / scale), divided by its row maximum to avoid overflow
+        z = np.where(valid, -x / scale[:, None], -np.inf)
+        z_max = z.max(axis=1)
+        return np.exp(z - z_max[:, None]), z_max
+
+    for _ in range(max_iter):
+        w, _ = get_weights(scale)
+        sw, swx, swx2 = w.sum(axis=1), (w * x).sum(axis=1), (w * x**2).sum(1)
+        g = scale + swx / sw
+        dg = 1 + (swx2 * sw - swx**2) / (scale**2 * sw**2)
+        step = g / dg
+        scale = np.maximum(scale - step, scale / 10)
+        if np.nanmax(np.abs(step) / scale, initial=0) < tol:
+            break
+    w, z_max = get_weights(scale)
+    loc = centre - scale * (np.log(w.sum(axis=1) / n) + z_max)
+    return loc, scale
+
+
+def _get_rps_and_values(cdf, ppf, return_periods, values, n_series):
+    results = {}
+    if return_periods is not None:
+        return_periods = np.asarray(return_periods, dtype=float)
+        results["return_values"] = ppf(1 - 1 / return_periods[None, :])
+    if values is not None:
+        values = np.broadcast_to(
+            np.atleast_2d(np.asarray(values, dtype=float)),
+            (n_series, np.shape(values)[-1]),
+        )
+        with np.errstate(divide="ignore"):
+            results["return_periods"] = 1 / (1 - cdf(values))
+    return results
+
+
+def fit_gumbel_batch(
+    annual_max,
+    return_periods=None,
+    values=None,
+    method: Literal["lmoments", "mle"] = "lmoments",
+    max_iter: int = 50,
+    tol: float = 1e-10,
+) -> dict:
+    """Fit a Gumbel distribution to many series of annual maxima at once.
+
+    Parameters are estimated for all series together with L-moments, and
+    optionally refined to the maximum likelihood estimate, which is what
+    `stats.gumbel_r.fit` gives for a single series.
+
+    Parameters
+    ----------
+    annual_max : array_like
+        Annual maxima, shaped (series x years), such as the output of
+        `get_annual_maxima`. Series can have different lengths, padded
+        with NaN.
+    return_periods : array_like, optional
+        Return periods in years for which to estimate values.
+    values : array_like, optional
+        Values for which to estimate return periods, either one list for
+        all series or shaped (series x values).
+    method : Literal["lmoments", "mle"], optional
+        How to estimate the parameters, by default "lmoments".
+    max_iter : int, optional
+        Maximum number of iterations for "mle", by default 50.
+    tol : float, optional
+        Relative tolerance on the scale for "mle", by default 1e-10.
+
+    Returns
+    -------
+    dict
+        `loc` and `scale` shaped (series,), plus `return_values` shaped
+        (series x return periods) if `return_periods` is given and
+        `return_periods` shaped (series x values) if `values` is given.
+    """
+    annual_max = np.atleast_2d(np.asarray(annual_max, dtype=float))
+    l1, l2, _ = _get_lmoments(annual_max)
+    scale = l2 / np.log(2)
+    loc = l1 - np.euler_gamma * scale
+    if method == "mle":
+        loc, scale = _refine_gumbel_mle(annual_max, scale, max_iter, tol)
+    elif method != "lmoments":
+        raise ValueError(f"Invalid method: {method}")
+
+    def cdf(x):
+        return np.exp(-np.exp(-(x - loc[:, None]) / scale[:, None]))
+
+    def ppf(p):
+        return loc[:, None] - scale[:, None] * np.log(-np.log(p))
+
+    return {
+        "loc": loc,
+        "scale": scale,
+        **_get_rps_and_values(
+            cdf, ppf, return_periods, values, len(annual_max)
+        ),
+    }
+
+
+def fit_gev_batch(annual_max, return_periods=None, values=None) -> dict:
+    """Fit a GEV distribution to many series of annual maxima at once, with
+    L-moments.
+
+    The shape is estimated with Hosking's approximation, and follows the
+    sign convention of `stats.genextreme`: positive for a distribution
+    bounded above, 0 for Gumbel.
+
+    Parameters
+    ----------
+    annual_max : array_like
+        Annual maxima, shaped (series x years). See `fit_gumbel_batch`.
+    return_periods : array_like, optional
+        Return periods in years for which to estimate values.
+    values : array_like, optional
+        Values for which to estimate return periods, either one list for
+        all series or shaped (series x values).
+
+    Returns
+    -------
+    dict
+        `loc`, `scale` and `shape` shaped (series,), plus `return_values`
+        and `return_periods` as for `fit_gumbel_batch`.
+    """
+    annual_max = np.atleast_2d(np.asarray(annual_max, dtype=float))
+    l1, l2, l3 = _get_lmoments(annual_max)
+    c = 2 / (3 + l3 / l2) - np.log(2) / np.log(3)
+    shape = 7.8590 * c + 2.9554 * c**2
+    # Use the Gumbel limit where the shape is 0
+    k = np.where(shape == 0, 1, shape)
+    gamma = special.gamma(1 + k)
+    scale = np.where(
+        shape == 0, l2 / np.log(2), l2 * k / ((1 - 2 ** (-k)) * gamma)
+    )
+    loc = np.where(
+        shape == 0,
+        l1 - np.euler_gamma * scale,
+        l1 - scale * (1 - gamma) / k,
+    )
+    dist = stats.genextreme(
+        shape[:, None], loc=loc[:, None], scale=scale[:, None]
+    )
+    return {
+        "loc": loc,
+        "scale": scale,
+        "shape": shape,
+        **_get_rps_and_values(
+            dist.cdf, dist.ppf, return_periods, values, len(annual_max)
+        ),
+    }
+
+
+def calculate_combined_rp(
+    df: pd.DataFrame,
+    rp_col: str,
+    year_col: str = "year",
+    total_years: Optional[int] = None,
+) -> pd.DataFrame:
+    """Calculate the combined RP of triggering on any of several series.
+
+    For each individual RP threshold, the combined RP is that of any series
+    (e.g. any LGA) reaching that RP in a year: (total years + 1) divided by
+    the number of distinct years in which at least one series does. A year
+    reaches a threshold if its highest individual RP does, so the whole
+    curve comes from sorting the yearly highest RPs once, instead of
+    filtering the data for each threshold.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        One row per series and year, with individual RPs in `rp_col`, such
+        as the output of `calculate_groups_rp`.
+    rp_col : str
+        Name of the column with individual RPs.
+    year_col : str, optional
+        Name of the column with years, by default "year".
+    total_years : int, optional
+        Length of the record, by default the number of distinct years in
+        `df`.
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame with columns 'rp_ind' (each distinct individual RP, in
+        ascending order) and 'rp_combined'.
+    """
+    if total_years is None:
+        total_years = df[year_col].nunique()
+    year_max = np.sort(df.groupby(year_col)[rp_col].max().to_numpy())
+    rp_ind = np.unique(df[rp_col].dropna().to_numpy())
+    # Years whose highest RP is at least each individual RP
+    n_years = len(year_max) - np.searchsorted(year_max, rp_ind, side="left")
+    with np.errstate(divide="ignore"):
+        rp_combined = (total_years + 1) / n_years
+    return pd.DataFrame({"rp_ind": rp_ind, "rp_combined": rp_combined})
+
+
+def get_combined_rp_thresholds(
+    df: pd.DataFrame,
+    by: List,
+    col_name: str,
+    target_rp: float,
+    year_col: str = "year",
+    ascending: bool = False,
+) -> pd.DataFrame:
+    """Get the threshold for each series that gives a target combined RP.
+
+    The individual RP used is the highest one whose combined RP (see
+    `calculate_combined_rp`) is no more than `target_rp`. Each series'
+    threshold is then its least severe value with at least that RP, so
+    that triggering when any series reaches its threshold reproduces the
+    combined RP over the record.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        One row per series and year, with values in `col_name` and
+        individual RPs in `{col_name}_rp`, as output by
+        `calculate_groups_rp`.
+    by : List
+        The columns identifying each series, e.g. ["pcode"].
+    col_name : str
+        The name of the column with values.
+    target_rp : float
+        Target combined RP in years.
+    year_col : str, optional
+        Name of the column with years, by default "year".
+    ascending : bool, optional
+        As passed to `calculate_groups_rp`, by default False, meaning high
+        values are severe.
+
+    Returns
+    -------
+    pd.DataFrame
+        The `by` columns, the threshold in `col_name`, the individual RP
+        in `rp_ind` and the combined RP in `rp_combined`.
+    """
+    rp_col = f"{col_name}_rp"
+    df_curve = calculate_combined_rp(df, rp_col, year_col=year_col)
+    df_curve = df_curve[df_curve["rp_combined"] <= target_rp]
+    if df_curve.empty:
+        raise ValueError(
+            f"No individual RP gives a combined RP of {target_rp} or less"
+        )
+    rp_ind, rp_combined = df_curve.iloc[-1]
+    grouped = df[df[rp_col] >= rp_ind].groupby(by, observed=True)[col_name]
+    thresholds = grouped.max() if ascending else grouped.min()
+    df_thresholds = thresholds.reindex(
+        df.groupby(by, observed=True).size().index
+    ).reset_index()
+    df_thresholds["rp_ind"] = rp_ind
+    df_thresholds["rp_combined"] = rp_combined
+    return df_thresholds
+
+
+def _get_bootstrap_samples(
+    values: np.ndarray, n_resamples: int, seed: Optional[int]
+) -> np.ndarray:
+    """Draw all bootstrap resamples of `values` with one index matrix,
+    shaped (resamples x len(values))."""
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(values), size=(n_resamples, len(values)))
+    return values[idx]
+
+
+def bootstrap_return_periods(
+    df: pd.DataFrame,
+    date_col: str,
+    val_col: str,
+    target_rps: Optional[List[Union[int, float]]] = None,
+    n_resamples: int = 10000,
+    confidence: float = 0.9,
+    method: Literal["lmoments", "mle"] = "mle",
+    seed: Optional[int] = None,
+) -> pd.DataFrame:
+    """Estimate return period values with bootstrap confidence intervals.
+
+    The point estimates are those of `estimate_return_periods`. The annual
+    maxima are resampled with replacement, and a Gumbel distribution is
+    fitted to all resamples at once with `fit_gumbel_batch`.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Input dataframe containing time series data
+    date_col : str
+        Name of the column containing dates
+    val_col : str
+        Name of the column containing values (e.g., streamflow)
+    target_rps : array_like, optional
+        List or array of target return periods in years
+        Default is [2, 3, 5, 7, 10]
+    n_resamples : int, optional
+        Number of bootstrap resamples, by default 10000.
+    confidence : float, optional
+        Width of the confidence interval, by default 0.9.
+    method : Literal["lmoments", "mle"], optional
+        How to fit each resample, by default "mle", as
+        `estimate_return_periods` does.
+    seed : int, optional
+        Seed for the resampling.
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with columns 'return_period', 'value', 'lower' and
+        'upper'.
+    """
+    if target_rps is None:
+        target_rps = [2, 3, 5, 7, 10]
+    df_rp = estimate_return_periods(df, date_col, val_col, target_rps)
+    annual_max = get_annual_maxima(df, date_col, val_col).iloc[0]
+    samples = _get_bootstrap_samples(
+        annual_max.dropna().to_numpy(), n_resamples, seed
+    )
+    return_values = fit_gumbel_batch(
+        samples, return_periods=target_rps, method=method
+    )["return_values"]
+    alpha = (1 - confidence) / 2
+    df_rp["lower"] = np.nanquantile(return_values, alpha, axis=0)
+    df_rp["upper"] = np.nanquantile(return_values, 1 - alpha, axis=0)
+    return df_rp
+
+
+def bootstrap_empirical_rp(
+    values,
+    thresholds,
+    n_resamples: int = 10000,
+    confidence: float = 0.9,
+    ascending: bool = False,
+    seed: Optional[int] = None,
+) -> pd.DataFrame:
+    """Estimate the empirical RP of thresholds with bootstrap confidence
+    intervals.
+
+    The empirical RP of a threshold is (n + 1) / (number of years at or
+    beyond the threshold), consistent with `calculate_one_group_rp`. All
+    resamples are counted at once.
+
+    Parameters
+    ----------
+    values : array_like
+        One value per year, e.g. annual maxima.
+    thresholds : array_like
+        Thresholds for which to estimate the RP.
+    n_resamples : int, optional
+        Number of bootstrap resamples, by default 10000.
+    confidence : float, optional
+        Width of the confidence interval, by default 0.9.
+    ascending : bool, optional
+        Whether low values are severe, by default False, so that a year
+        reaches a threshold if it is at or above it. See
+        `calculate_one_group_rp`.
+    seed : int, optional
+        Seed for the resampling.
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame with columns 'value', 'return_period', 'lower' and
+        'upper'. RPs are infinite if no year reaches the threshold.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    thresholds = np.asarray(thresholds, dtype=float)
+    sign = 1 if ascending else -1
+    n = len(values)
+
+    def get_rps(samples):
+        counts = (
+            sign * samples[..., None] <= sign * thresholds[None, None, :]
+        ).sum(axis=1)
+        with np.errstate(divide="ignore"):
+            return (n + 1) / counts
+
+    samples = _get_bootstrap_samples(values, n_resamples, seed)
+    rps = get_rps(samples)
+    alpha = (1 - confidence) / 2
+    return pd.DataFrame(
+        {
+            "value": thresholds,
+            "return_period": get_rps(values[None, :])[0],
+            # Resampled RPs can be infinite, so take the nearest one rather
+            # than interpolating
+            "lower": np.quantile(rps, alpha, axis=0, method="nearest"),
+            "upper": np.quantile(rps, 1 - alpha, axis=0, method="nearest"),
+        }
+    )
+
+
 def interpolate_return_period(
     df: pd.DataFrame, rp_col: str, val_col: str, target_vals: list
 ) -> pd.DataFrame:
@@ -0,0 +1,63 @@
+import json
+import uuid
+
+
+class FakeCDSRemote:
+    """Simulated CDS request, as returned by `FakeCDSClient.submit`.
+
+    Like an `ecmwf.datastores.Remote`, its `status` moves from accepted to
+    running to successful (or failed), here one step per check rather than
+    as time passes.
+    """
+
+    def __init__(self, request_id, request, n_queued, n_running, fail):
+        self.request_id = request_id
+        self.request = request
+        self._statuses = (
+            ["accepted"] * n_queued
+            + ["running"] * n_running
+            + ["failed" if fail else "successful"]
+        )
+        self._n_checks = 0
+
+    @property
+    def status(self):
+        status = self._statuses[min(self._n_checks, len(self._statuses) - 1)]
+        self._n_checks += 1
+        return status
+
+    def download(self, target=None):
+        with open(target, "w") as f:
+            json.dump(self.request, f, sort_keys=True)
+        return target
+
+
+class FakeCDSClient:
+    """Local stand-in for an `ecmwf.datastores.Client`.
+
+    Requests are accepted for `n_queued` status checks and running for
+    `n_running`, then either succeed, writing the request as JSON to the
+    download target, or fail if `fail` returns True for the request.
+    """
+
+    def __init__(self, n_queued: int = 1, n_running: int = 1, fail=None):
+        self.n_queued = n_queued
+        self.n_running = n_running
+        self.fail = fail
+        self.jobs = {}
+        self.n_submitted = 0
+
+    def submit(self, collection_id, request):
+        request_id = str(uuid.uuid4())
+        self.jobs[request_id] = FakeCDSRemote(
+            request_id,
+            {"dataset": collection_id, **request},
+            self.n_queued,
+            self.n_running,
+            self.fail is not None and self.fail(request),
+        )
+        self.n_submitted += 1
+        return self.jobs[request_id]
+
+    def get_remote(self, request_id):
+        return self.jobs[request_id]
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+from src.utils import cds_utils
+from tests.fake_cds import FakeCDSClient
+
+
+def _get_jobs(tmp_path, n=3):
+    return {
+        str(tmp_path / f"out_{i}.json"): ("dataset", {"year": str(2000 + i)})
+        for i in range(n)
+    }
+
+
+def _download(jobs, tmp_path, client):
+    return cds_utils.download_cds_requests(
+        jobs,
+        manifest_path=tmp_path / "manifest.json",
+        max_in_flight=2,
+        poll_interval=0,
+        to_blob=False,
+        client=client,
+    )
+
+
+def _load_manifest(tmp_path):
+    with open(tmp_path / "manifest.json") as f:
+        return json.load(f)
+
+
+def test_download_cds_requests_all(tmp_path):
+    jobs = _get_jobs(tmp_path)
+    client = FakeCDSClient()
+    states = _download(jobs, tmp_path, client)
+    assert states == {x: "done" for x in jobs}
+    assert client.n_submitted == len(jobs)
+    for target, (dataset, request) in jobs.items():
+        with open(target) as f:
+            assert json.load(f) == {"dataset": dataset, **request}
+
+
+def test_download_cds_requests_skips_done(tmp_path):
+    jobs = _get_jobs(tmp_path)
+    _download(jobs, tmp_path, FakeCDSClient())
+    client = FakeCDSClient()
+    states = _download(jobs, tmp_path, client)
+    assert states == {x: "done" for x in jobs}
+    assert client.n_submitted == 0
+
+
+def test_download_cds_requests_resubmits_missing(tmp_path):
+    jobs = _get_jobs(tmp_path)
+    _download(jobs, tmp_path, FakeCDSClient())
+    missing, truncated = list(jobs)[:2]
+    Path(missing).unlink()
+    open(truncated, "w").close()
+    client = FakeCDSClient()
+    states = _download(jobs, tmp_path, client)
+    assert states == {x: "done" for x in jobs}
+    assert client.n_submitted == 2
+    for target in (missing, truncated):
+        with open(target) as f:
+            assert json.load(f)["year"] == jobs[target][1]["year"]
+
+
+def test_download_cds_requests_resumes_queued(tmp_path):
+    jobs = _get_jobs(tmp_path)
+    client = FakeCDSClient()
+    # Requests queued by an interrupted run
+    manifest = {
+        target: {
+            "state": "queued",
+            "request_id": client.submit(*jobs[target]).request_id,
+        }
+        for target in jobs
+    }
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+    states = _download(jobs, tmp_path, client)
+    assert states == {x: "done" for x in jobs}
+    assert client.n_submitted == len(jobs)
+    assert {
+        x: y["request_id"] for x, y in _load_manifest(tmp_path).items()
+    } == {x: y["request_id"] for x, y in manifest.items()}
+
+
+def test_download_cds_requests_resubmits_unknown(tmp_path):
+    jobs = _get_jobs(tmp_path, n=1)
+    (target,) = jobs
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump({target: {"state": "running", "request_id": "gone"}}, f)
+    client = FakeCDSClient()
+    assert _download(jobs, tmp_path, client) == {target: "done"}
+    assert client.n_submitted == 1
+
+
+def test_download_cds_requests_retries_failed(tmp_path):
+    jobs = _get_jobs(tmp_path)
+    failing = list(jobs)[0]
+
+    def fail(request):
+        return request == jobs[failing][1]
+
+    states = _download(jobs, tmp_path, FakeCDSClient(fail=fail))
+    assert states == {x: "failed" if x == failing else "done" for x in jobs}
+    assert "error" in _load_manifest(tmp_path)[failing]
+    client = FakeCDSClient()
+    states = _download(jobs, tmp_path, client)
+    assert states == {x: "done" for x in jobs}
+    assert client.n_submitted == 1
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.datasources import glofas
+
+
+def _get_glofas_grid_coords_argmin(lon, lat):
+    # Lookup get_glofas_grid_coords replaced, searching the full grid
+    grid_lat = np.arange(-90.025, 90, 0.05)
+    grid_lon = np.arange(-180.025, 180, 0.05)
+    nearest_lat_idx = (np.abs(grid_lat - lat)).argmin()
+    nearest_lon_idx = (np.abs(grid_lon - lon)).argmin()
+    return round(grid_lon[nearest_lon_idx], 3), round(
+        grid_lat[nearest_lat_idx], 3
+    )
+
+
+def _get_test_points():
+    rng = np.random.default_rng(42)
+    lons = rng.uniform(-181, 181, 2000)
+    lats = rng.uniform(-91, 91, 2000)
+    # Points exactly halfway between cell centres, where the lower index
+    # must win as with argmin
+    edge_lons = np.arange(-180.025, 180, 0.05)[::50] + 0.025
+    edge_lats = np.arange(-90.025, 90, 0.05)[::25] + 0.025
+    n = min(len(edge_lons), len(edge_lats))
+    lons = np.concatenate([lons, edge_lons[:n]])
+    lats = np.concatenate([lats, edge_lats[:n]])
+    return lons, lats
+
+
+def test_get_glofas_grid_coords_scalar_matches_argmin():
+    for lon, lat in zip(*_get_test_points()):
+        assert glofas.get_glofas_grid_coords(
+            lon, lat
+        ) == _get_glofas_grid_coords_argmin(lon, lat)
+
+
+def test_get_glofas_grid_coords_array_matches_argmin():
+    lons, lats = _get_test_points()
+    grid_lon, grid_lat = glofas.get_glofas_grid_coords(lons, lats)
+    expected = [
+        _get_glofas_grid_coords_argmin(x, y) for x, y in zip(lons, lats)
+    ]
+    np.testing.assert_array_equal(grid_lon, [x[0] for x in expected])
+    np.testing.assert_array_equal(grid_lat, [x[1] for x in expected])
+
+
+@pytest.mark.parametrize("lon, lat", [(math.nan, 9.383), (12.767, math.nan)])
+def test_get_glofas_grid_coords_nan(lon, lat):
+    grid_lon, grid_lat = glofas.get_glofas_grid_coords(lon, lat)
+    assert math.isnan(grid_lon) == math.isnan(lon)
+    assert math.isnan(grid_lat) == math.isnan(lat)
+    grid_lon, grid_lat = glofas.get_glofas_grid_coords(
+        np.array([lon, 12.767]), np.array([lat, 9.383])
+    )
+    assert np.isnan(grid_lon[0]) == math.isnan(lon)
+    assert np.isnan(grid_lat[0]) == math.isnan(lat)
+    assert (grid_lon[1], grid_lat[1]) == glofas.get_glofas_grid_coords(
+        12.767, 9.383
+    )
+
+
+def test_read_grib_points_no_points(tmp_path):
+    df = glofas.read_grib_points(tmp_path / "missing.grib", {})
+    assert df.empty
+    assert list(df.columns) == ["station", "time", "step", "number", "value"]
+    assert pd.api.types.is_datetime64_any_dtype(df["time"])
+    assert pd.api.types.is_timedelta64_dtype(df["step"])
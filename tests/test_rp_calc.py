@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.utils import rp_calc
+
+
+def _calculate_groups_rp_apply(df, by, col_name="mean", ascending=True):
+    # Per-group loop calculate_groups_rp replaced
+    return (
+        df.groupby(by)
+        .apply(
+            rp_calc.calculate_one_group_rp,
+            col_name=col_name,
+            ascending=ascending,
+            include_groups=False,
+        )
+        .reset_index()
+        .drop(columns=f"level_{len(by)}")
+    )
+
+
+def _get_test_df(n_groups, n_years=26, seed=0):
+    rng = np.random.default_rng(seed)
+    pcodes = [f"NG{i:05d}" for i in range(n_groups)]
+    df = pd.DataFrame(
+        {
+            "ADM2_PCODE": np.repeat(pcodes, n_years),
+            "year": np.tile(np.arange(1998, 1998 + n_years), n_groups),
+            # Rounded so some values tie
+            "mean": rng.gamma(2, 50, n_groups * n_years).round(-1),
+        }
+    )
+    # Shuffle, so groups aren't contiguous
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("ascending", [True, False])
+def test_calculate_groups_rp_matches_apply(ascending):
+    df = _get_test_df(50)
+    pd.testing.assert_frame_equal(
+        rp_calc.calculate_groups_rp(df, ["ADM2_PCODE"], ascending=ascending),
+        _calculate_groups_rp_apply(df, ["ADM2_PCODE"], ascending=ascending),
+    )
+
+
+def test_calculate_groups_rp_multi_and_missing_keys():
+    df = _get_test_df(20)
+    df["adm1"] = df["ADM2_PCODE"].str[:6]
+    df.loc[df.index[::37], "ADM2_PCODE"] = None
+    pd.testing.assert_frame_equal(
+        rp_calc.calculate_groups_rp(df, ["adm1", "ADM2_PCODE"]),
+        _calculate_groups_rp_apply(df, ["adm1", "ADM2_PCODE"]),
+    )
+
+
+def test_calculate_groups_rp_10k_groups():
+    df = _get_test_df(10_000)
+    start = time.perf_counter()
+    result = rp_calc.calculate_groups_rp(df, ["ADM2_PCODE"])
+    vectorised = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = _calculate_groups_rp_apply(df, ["ADM2_PCODE"])
+    looped = time.perf_counter() - start
+    print(f"10k groups: loop {looped:.2f} s, vectorised {vectorised:.3f} s")
+    pd.testing.assert_frame_equal(result, expected)
+    assert vectorised * 5 < looped